@@ -7,12 +7,19 @@ from flask import (
     redirect,
     url_for,
     send_from_directory,
+    send_file,
     flash,
+    stream_with_context,
+    g,
+    has_request_context,
+    session,
 )
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, func
+from sqlalchemy import text, func, event, case, select, update
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, make_transient_to_detached
 from flask_login import (
     LoginManager,
     login_user,
@@ -24,6 +31,9 @@ from flask_login import (
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.exceptions import HTTPException
 import traceback
+import csv
+import time
+import click
 import requests
 import qrcode
 from qrcode.image.styledpil import StyledPilImage
@@ -37,26 +47,78 @@ from qrcode.image.styles.colormasks import (
     SolidFillColorMask,
     VerticalGradiantColorMask,
 )
-import qrcode.image.svg
-from PIL import ImageColor
+from PIL import Image, ImageChops, ImageColor, features
 import stripe
 import secrets
 import string
+import hashlib
+import io
+import gzip
+import json
+import sqlite3
+import threading
+import queue
+import atexit
+import zipfile
+import sys
+import heapq
+import bisect
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from urllib.parse import urlsplit
 
 # Load environment variables from a .env file if present.
 # Override existing environment variables to ensure the latest
-# values from the .env file are always used.
-load_dotenv(os.path.join(os.path.dirname(__file__), '.env'), override=True)
+# values from the .env file are always used. Worker processes inherit the
+# variables from a server that loaded them already.
+if os.environ.get('QRCODE_ENV_LOADED') != '1':
+    load_dotenv(os.path.join(os.path.dirname(__file__), '.env'), override=True)
+    os.environ['QRCODE_ENV_LOADED'] = '1'
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev')
 # Use a database file inside the application directory. This avoids absolute
 # paths that may not exist when the application is started via systemd or in
-# other environments.
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
-    app.root_path, 'database.db'
+# other environments. DATABASE_URL and UPLOAD_FOLDER override the defaults,
+# e.g. for benchmarks against a scratch database.
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or (
+    'sqlite:///' + os.path.join(app.root_path, 'database.db')
 )
-app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'qrcodes')
+# Hosting providers often hand out postgres:// URLs, SQLAlchemy needs the
+# full dialect name. PostgreSQL requires the psycopg2 package.
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres://'):
+    app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace(
+        'postgres://', 'postgresql://', 1
+    )
+# WAL journal and connection pragmas for SQLite, see configure_sqlite()
+app.config['SQLITE_TUNING'] = os.environ.get('SQLITE_TUNING', '1') != '0'
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+app.config['SQLITE_MMAP_MB'] = int(os.environ.get('SQLITE_MMAP_MB', '256'))
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': True,
+    }
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER') or os.path.join(
+    app.root_path, 'qrcodes'
+)
+# Rendered images shared between identical QR codes
+app.config['RENDER_CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.cache')
+app.config['RENDER_CACHE_MEMORY_BYTES'] = int(
+    os.environ.get('RENDER_CACHE_MEMORY_MB', '32')
+) * 1024 * 1024
+app.config['RENDER_CACHE_DISK_BYTES'] = int(
+    os.environ.get('RENDER_CACHE_DISK_MB', '512')
+) * 1024 * 1024
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Stripe configuration
@@ -66,7 +128,17 @@ verify_env = os.environ.get('STRIPE_VERIFY_SSL', '1').lower()
 stripe.verify_ssl_certs = verify_env not in ('0', 'false')
 
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+def sqlite_database_path(uri):
+    """Return the file of a SQLite database URI, None for other databases.
+
+    Relative paths are resolved against the instance folder like
+    Flask-SQLAlchemy does; in-memory databases have no file.
+    """
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return os.path.join(app.instance_path, url.database)
+
 
 # Check permissions for important paths
 def check_permissions():
@@ -80,18 +152,16 @@ def check_permissions():
     except Exception:
         issues.append(f'Schreibrechte fehlen im Verzeichnis {upload_dir}')
 
-    db_path = os.path.join(app.root_path, 'database.db')
-    try:
-        with open(db_path, 'a'):
-            pass
-    except Exception:
-        issues.append(f'Schreibrechte fehlen bei der Datei {db_path}')
+    db_path = sqlite_database_path(app.config['SQLALCHEMY_DATABASE_URI'])
+    if db_path:
+        try:
+            with open(db_path, 'a'):
+                pass
+        except Exception:
+            issues.append(f'Schreibrechte fehlen bei der Datei {db_path}')
 
     app.config['PERMISSION_ISSUES'] = issues
 
-# Run permission check at startup
-check_permissions()
-
 # Allowed number of QR codes per plan
 PLAN_LIMITS = {
     'basic': 1,
@@ -150,6 +220,12 @@ def inject_plan_limits():
 def inject_plan_utils():
     return {'is_higher_plan': is_higher_plan}
 
+# Expose the download formats to templates; codes without a stored render
+# spec only offer their stored QR_FORMATS files
+@app.context_processor
+def inject_download_formats():
+    return {'DOWNLOAD_FORMATS': DOWNLOAD_FORMATS, 'QR_FORMATS': QR_FORMATS}
+
 # Expose permission issues to templates
 @app.context_processor
 def inject_permission_issues():
@@ -159,22 +235,47 @@ def inject_permission_issues():
 
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    """Enable WAL and the connection pragmas on every new SQLite connection.
+
+    WAL lets readers continue while one writer commits; writers wait up to
+    SQLITE_BUSY_TIMEOUT_MS for the lock instead of failing right away.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not app.config['SQLITE_TUNING']:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.execute(f"PRAGMA mmap_size={app.config['SQLITE_MMAP_MB'] * 1024 * 1024}")
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(255), unique=True)
     password_hash = db.Column(db.String(255))
     name = db.Column(db.String(255))
     email = db.Column(db.String(255), unique=True)
-    plan = db.Column(db.String(20), default='basic')
+    # Active history keeps the previous plan available to the rollup hooks
+    plan = db.column_property(
+        db.Column(db.String(20), default='basic', index=True), active_history=True
+    )
     upgrade_method = db.Column(db.String(20))
     paypal_subscription_id = db.Column(db.String(255))
     stripe_subscription_id = db.Column(db.String(255))
     plan_expires_at = db.Column(db.DateTime(timezone=True))
     plan_cancelled = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow, index=True)
     qrcodes = db.relationship('QRCode', backref='user', lazy=True)
 
 class QRCode(db.Model):
+    # Keyset pagination walks a user's codes in id order
+    __table_args__ = (db.Index('ix_qr_code_user_id_id', 'user_id', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     public_id = db.Column(
         db.String(16), unique=True, index=True, nullable=False, default=generate_public_id
@@ -182,46 +283,690 @@ class QRCode(db.Model):
     url = db.Column(db.String(2048))
     data_type = db.Column(db.String(20), default='url')
     description = db.Column(db.String(255))
-    created_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow, index=True)
     png_path = db.Column(db.String(255))
     svg_path = db.Column(db.String(255))
     jpg_path = db.Column(db.String(255))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # Render spec used to (re)create the image files on demand
+    payload = db.Column(db.String(2048))
+    color = db.Column(db.String(32), default='black')
+    bgcolor = db.Column(db.String(32), default='white')
+    style = db.Column(db.String(20), default='square')
+    gradient = db.Column(db.Boolean, default=False)
+    gradient_color = db.Column(db.String(32))
+    # 'pending' while a background render job is queued, otherwise 'done'
+    # or 'failed'
+    render_status = db.Column(db.String(20), default='done')
 
     @property
     def created_at_local(self):
         return self.created_at.astimezone(ZoneInfo("Europe/Berlin"))
 
+    @property
+    def render_key(self):
+        """Hash of the render spec or None for codes without a stored spec."""
+        if not self.payload:
+            return None
+        try:
+            return render_cache_key(
+                self.payload,
+                self.color,
+                self.bgcolor,
+                self.style,
+                self.gradient,
+                self.gradient_color,
+            )
+        except ValueError:
+            return None
+
+    @property
+    def render_version(self):
+        """Short version token used to build immutable image URLs."""
+        key = self.render_key
+        return key[:12] if key else None
+
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    amount = db.Column(db.Integer)
-    period = db.Column(db.String(10))
+    amount = db.column_property(db.Column(db.Integer), active_history=True)
+    period = db.column_property(db.Column(db.String(10), index=True), active_history=True)
+    created_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow, index=True)
+
+    # Payment history of a user, newest first
+    __table_args__ = (db.Index('ix_payment_user_id_created_at', 'user_id', 'created_at'),)
+
+
+# Statistics rollups, maintained by the mapper hooks below
+
+class StatsHourly(db.Model):
+    kind = db.Column(db.String(20), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+
+class RevenueMonthly(db.Model):
+    month = db.Column(db.String(7), primary_key=True)
+    amount = db.Column(db.Integer, default=0, nullable=False)
+    monthly_count = db.Column(db.Integer, default=0, nullable=False)
+    yearly_count = db.Column(db.Integer, default=0, nullable=False)
+
+
+class PlanCount(db.Model):
+    plan = db.Column(db.String(20), primary_key=True)
+    users = db.Column(db.Integer, default=0, nullable=False)
+
+
+class StatsCounter(db.Model):
+    name = db.Column(db.String(20), primary_key=True)
+    value = db.Column(db.Integer, default=0, nullable=False)
+
+
+class ScanEvent(db.Model):
+    """A single scan, written in batches by the scan flusher."""
+    id = db.Column(db.Integer, primary_key=True)
+    public_id = db.Column(db.String(16), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    device = db.Column(db.String(10))
+    referrer = db.Column(db.String(255))
+
+
+class ScanHourly(db.Model):
+    public_id = db.Column(db.String(16), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+
+def upsert_increment(connection, model, keys, increments):
+    """Add increments to the rollup row identified by keys, creating it."""
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = model.__table__
+    stmt = insert(table).values(**keys, **increments)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={col: table.c[col] + stmt.excluded[col] for col in increments},
+    )
+    connection.execute(stmt)
+
+
+def _hour(value):
+    return (value or datetime.utcnow()).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+
+def _revenue_increments(amount, period, sign=1):
+    return {
+        'amount': sign * (amount or 0),
+        'monthly_count': sign * (period == 'month'),
+        'yearly_count': sign * (period == 'year'),
+    }
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    upsert_increment(
+        connection, StatsHourly, {'kind': 'signups', 'bucket': _hour(target.created_at)}, {'count': 1}
+    )
+    upsert_increment(connection, PlanCount, {'plan': target.plan or 'basic'}, {'users': 1})
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.plan.history
+    if history.deleted and history.added and history.deleted[0] != history.added[0]:
+        upsert_increment(connection, PlanCount, {'plan': history.deleted[0] or 'basic'}, {'users': -1})
+        upsert_increment(connection, PlanCount, {'plan': history.added[0] or 'basic'}, {'users': 1})
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    upsert_increment(connection, PlanCount, {'plan': target.plan or 'basic'}, {'users': -1})
+
+
+@event.listens_for(QRCode, 'after_insert')
+def _qrcode_inserted(mapper, connection, target):
+    upsert_increment(
+        connection, StatsHourly, {'kind': 'qrcodes', 'bucket': _hour(target.created_at)}, {'count': 1}
+    )
+    upsert_increment(connection, StatsCounter, {'name': 'qrcodes'}, {'value': 1})
+
+
+@event.listens_for(QRCode, 'after_delete')
+def _qrcode_deleted(mapper, connection, target):
+    upsert_increment(connection, StatsCounter, {'name': 'qrcodes'}, {'value': -1})
+    connection.execute(db.delete(ScanHourly).where(ScanHourly.public_id == target.public_id))
+
+
+@event.listens_for(Payment, 'after_insert')
+def _payment_inserted(mapper, connection, target):
+    month = (target.created_at or datetime.utcnow()).strftime('%Y-%m')
+    upsert_increment(
+        connection, RevenueMonthly, {'month': month}, _revenue_increments(target.amount, target.period)
+    )
+
+
+@event.listens_for(Payment, 'after_update')
+def _payment_updated(mapper, connection, target):
+    state = db.inspect(target).attrs
+    if not (state.amount.history.has_changes() or state.period.history.has_changes()):
+        return
+    old_amount = (state.amount.history.deleted or [target.amount])[0]
+    old_period = (state.period.history.deleted or [target.period])[0]
+    month = (target.created_at or datetime.utcnow()).strftime('%Y-%m')
+    upsert_increment(
+        connection, RevenueMonthly, {'month': month}, _revenue_increments(old_amount, old_period, -1)
+    )
+    upsert_increment(
+        connection, RevenueMonthly, {'month': month}, _revenue_increments(target.amount, target.period)
+    )
+
+
+@event.listens_for(Payment, 'after_delete')
+def _payment_deleted(mapper, connection, target):
+    month = (target.created_at or datetime.utcnow()).strftime('%Y-%m')
+    upsert_increment(
+        connection, RevenueMonthly, {'month': month}, _revenue_increments(target.amount, target.period, -1)
+    )
+
+
+def rebuild_stats():
+    """Recompute all rollup tables from the source tables."""
+    for model in (StatsHourly, RevenueMonthly, PlanCount, StatsCounter):
+        db.session.query(model).delete()
+    for kind, model in (('signups', User), ('qrcodes', QRCode)):
+        bucket = hour_bucket(model.created_at)
+        for hour, count in db.session.query(bucket, func.count(model.id)).group_by(bucket):
+            if hour:
+                db.session.add(
+                    StatsHourly(kind=kind, bucket=datetime.strptime(hour, '%Y-%m-%d %H'), count=count)
+                )
+    # Scan events are pruned after a while; their hourly counters are kept
+    for hour, count in db.session.query(
+        ScanHourly.bucket, func.sum(ScanHourly.count)
+    ).group_by(ScanHourly.bucket):
+        db.session.add(StatsHourly(kind='scans', bucket=hour, count=count))
+    month = month_bucket(Payment.created_at)
+    for month_value, amount, monthly, yearly in db.session.query(
+        month,
+        func.sum(Payment.amount),
+        func.count(case((Payment.period == 'month', Payment.id))),
+        func.count(case((Payment.period == 'year', Payment.id))),
+    ).group_by(month):
+        if month_value:
+            db.session.add(RevenueMonthly(
+                month=month_value, amount=amount or 0, monthly_count=monthly, yearly_count=yearly
+            ))
+    for plan, users in db.session.query(User.plan, func.count(User.id)).group_by(User.plan):
+        db.session.add(PlanCount(plan=plan or 'basic', users=users))
+    db.session.add(StatsCounter(name='qrcodes', value=QRCode.query.count()))
+    db.session.commit()
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the statistics rollup tables, e.g. after an upgrade."""
+    rebuild_stats()
+    click.echo('Statistics rebuilt')
+
+
+class RenderJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    qr_id = db.Column(db.Integer, db.ForeignKey('qr_code.id', ondelete='CASCADE'), index=True)
+    formats = db.Column(db.String(50))
+    # 'queued' until the worker finishes; successful jobs are deleted
+    status = db.Column(db.String(20), default='queued', index=True)
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime(timezone=True))
+
+
+class PendingDeletion(db.Model):
+    """File queued for removal by the deletion sweeper."""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), nullable=False)
     created_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
 
+
+class SchemaVersion(db.Model):
+    """Single row holding the number of the last applied migration."""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    migrated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class JobCheckpoint(db.Model):
+    """Resume position of an incremental background job."""
+    name = db.Column(db.String(50), primary_key=True)
+    position = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 # Login manager
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+app.config['USER_CACHE_SECONDS'] = float(os.environ.get('USER_CACHE_SECONDS', '30'))
+
+
+class UserCache:
+    """Short-lived per-process cache of the users loaded for login.
+
+    Cached users are detached snapshots; each request merges a copy into
+    its own session without a query. Entries are dropped when the user is
+    updated or deleted in this process and expire after USER_CACHE_SECONDS
+    otherwise.
+    """
+
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, snapshot = entry
+            if expires <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+        return db.session.merge(snapshot, load=False)
+
+    def put(self, user):
+        ttl = app.config['USER_CACHE_SECONDS']
+        if ttl <= 0:
+            return
+        snapshot = User(**{
+            attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs
+        })
+        make_transient_to_detached(snapshot)
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + ttl, snapshot)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _forget_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
+
+# GET routes that change the logged in user
+USER_WRITE_ENDPOINTS = ('cancel_subscription', 'stripe_success')
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """Return the logged in user, from the cache for read-only requests.
+
+    Requests that may change the user or enforce plan limits load it from
+    the database: the rollup hooks diff against the loaded plan and the
+    limits must not follow a plan changed by another process meanwhile.
+    """
+    user_id = int(user_id)
+    user = None
+    if request.method in ('GET', 'HEAD') and request.endpoint not in USER_WRITE_ENDPOINTS:
+        user = user_cache.get(user_id)
+    if user is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.put(user)
+    return user
+
+
+# Metrics
+
+class Metrics:
+    """Minimal thread-safe metric registry using the Prometheus text format."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+        self._local = threading.local()
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        captured = getattr(self._local, 'captured', None)
+        if captured is not None:
+            captured.append((name, value, labels))
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(self.BUCKETS, value)
+            if index < len(self.BUCKETS):
+                hist[0][index] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def capture(self):
+        """Collect the observations made by this thread, e.g. to hand them
+        from a render worker process back to the application."""
+        self._local.captured = captured = []
+        try:
+            yield captured
+        finally:
+            self._local.captured = None
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        body = ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in items
+        )
+        return '{' + body + '}'
+
+    def render(self, gauges=None):
+        """Return all metrics plus the given gauge values as text."""
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen and name in self._meta:
+                kind, help_text = self._meta[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+            seen.add(name)
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name)
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(
+                    f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}'
+                )
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        for name, value in (gauges or {}).items():
+            header(name)
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('qrcode_requests_total', 'counter', 'HTTP requests by endpoint and status.')
+metrics.describe('qrcode_request_duration_seconds', 'histogram', 'HTTP request latency.')
+metrics.describe('qrcode_db_queries_total', 'counter', 'Database queries issued by requests.')
+metrics.describe(
+    'qrcode_db_query_seconds_total', 'counter', 'Time spent in database queries by requests.'
+)
+metrics.describe(
+    'qrcode_render_stage_duration_seconds', 'histogram', 'Time spent in each render stage.'
+)
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads that are serving requests.
+
+    Enabled with PROFILE_REQUESTS=1 or at runtime via /metrics/profile. The
+    aggregated stacks of the slowest requests are kept for /metrics/slow.
+    """
+
+    def __init__(self, interval=0.005, keep=10):
+        self.interval = interval
+        self.keep = keep
+        self.enabled = False
+        self._active = {}
+        self._slowest = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enable(self):
+        with self._lock:
+            self.enabled = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+            self._active.clear()
+
+    def start_request(self):
+        if self.enabled:
+            with self._lock:
+                self._active[threading.get_ident()] = Counter()
+
+    def finish_request(self, duration, description):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+            if samples is None:
+                return
+            self._seq += 1
+            entry = (duration, self._seq, description, samples.most_common(20))
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+
+    def _run(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[self._stack(frame)] += 1
+
+    @staticmethod
+    def _stack(frame, depth=15):
+        entries = []
+        while frame is not None and len(entries) < depth:
+            code = frame.f_code
+            entries.append(f'{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}')
+            frame = frame.f_back
+        return ' <- '.join(entries)
+
+    def report(self):
+        """Return the slowest requests with their most frequent stacks."""
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        lines = [f'profiling {"enabled" if self.enabled else "disabled"}']
+        for duration, _, description, stacks in slowest:
+            lines.append('')
+            lines.append(f'{duration * 1000:.1f}ms {description}')
+            for stack, count in stacks:
+                lines.append(f'  {count:5d}  {stack}')
+        return '\n'.join(lines) + '\n'
+
+
+profiler = SamplingProfiler()
+if os.environ.get('PROFILE_REQUESTS') == '1':
+    profiler.enable()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_time = g.get('db_time', 0.0) + elapsed
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    profiler.start_request()
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+    duration = time.perf_counter() - start
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe(
+        'qrcode_request_duration_seconds', duration, endpoint=endpoint, method=request.method
+    )
+    metrics.inc('qrcode_requests_total', endpoint=endpoint, status=response.status_code)
+    metrics.inc('qrcode_db_queries_total', g.get('db_queries', 0), endpoint=endpoint)
+    metrics.inc('qrcode_db_query_seconds_total', g.get('db_time', 0.0), endpoint=endpoint)
+    profiler.finish_request(
+        duration,
+        f'{request.method} {request.full_path.rstrip("?")} '
+        f'-> {response.status_code} ({g.get("db_queries", 0)} queries)',
+    )
+    return response
+
+
+app.config['PLAN_EXPIRY_INTERVAL'] = float(os.environ.get('PLAN_EXPIRY_INTERVAL', '300'))
+
+
+def expire_cancelled_plans(now=None):
+    """Downgrade cancelled plans past their expiry date to basic.
+
+    One bulk UPDATE per old plan changes the expired users, then their QR
+    codes are cut down to the basic limit. The UPDATEs repeat the expiry
+    conditions and the rollup follows their row counts, so a concurrent run
+    cannot count a user twice. Returns the number of downgraded users.
+    """
+    now = now or datetime.utcnow()
+    expired = (
+        User.plan != 'basic',
+        User.plan_cancelled.is_(True),
+        User.plan_expires_at <= now,
+    )
+    user_ids = db.session.execute(select(User.id).where(*expired)).scalars().all()
+    if not user_ids:
+        return 0
+    old_plans = db.session.execute(
+        select(User.plan).where(User.id.in_(user_ids)).distinct()
+    ).scalars().all()
+    # Bulk updates bypass the mapper hooks of the rollups and the user cache
+    connection = db.session.connection()
+    downgraded = 0
+    for plan in old_plans:
+        count = db.session.execute(
+            update(User)
+            .where(User.id.in_(user_ids), User.plan == plan, *expired)
+            .values(plan='basic', plan_cancelled=False, paypal_subscription_id=None)
+        ).rowcount
+        if count:
+            upsert_increment(connection, PlanCount, {'plan': plan}, {'users': -count})
+            downgraded += count
+    if downgraded:
+        upsert_increment(connection, PlanCount, {'plan': 'basic'}, {'users': downgraded})
+    db.session.commit()
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+        enforce_qrcode_limit(db.session.get(User, user_id))
+    return downgraded
+
+
+# Lets processes without the sweeper (e.g. `flask run` or a server pointed at
+# app:app instead of wsgi:app) expire plans from the request path
+PLAN_EXPIRY_FALLBACK_SECONDS = 60
+_plan_expiry_checked = 0.0
 
 
 @app.before_request
 def check_plan_expiration():
-    if current_user.is_authenticated and current_user.plan != 'basic':
-        if (
-            current_user.plan_cancelled
-            and current_user.plan_expires_at
-            and current_user.plan_expires_at <= datetime.utcnow()
-        ):
-            current_user.plan = 'basic'
-            current_user.plan_cancelled = False
-            current_user.paypal_subscription_id = None
-            db.session.commit()
-            enforce_qrcode_limit(current_user)
+    """Expire cancelled plans at most once a minute per process.
+
+    A user whose own plan ran out is downgraded before the request is
+    served, as soon as the (possibly cached) user shows it.
+    """
+    global _plan_expiry_checked
+    now = time.monotonic()
+    own = (
+        current_user.is_authenticated
+        and current_user.plan != 'basic'
+        and current_user.plan_cancelled
+        and current_user.plan_expires_at
+        and current_user.plan_expires_at <= datetime.utcnow()
+    )
+    if own or now - _plan_expiry_checked >= PLAN_EXPIRY_FALLBACK_SECONDS:
+        _plan_expiry_checked = now
+        try:
+            expire_cancelled_plans()
+            if own:
+                # Another process may have downgraded the user already
+                user_cache.invalidate(current_user.id)
+        except Exception as e:
+            db.session.rollback()
+            print('Plan expiry failed:', e)
+
+
+_plan_expiry_thread = None
+
+
+def start_plan_expiry_sweeper():
+    """Run expire_cancelled_plans() every PLAN_EXPIRY_INTERVAL seconds."""
+    global _plan_expiry_thread
+    interval = app.config['PLAN_EXPIRY_INTERVAL']
+    if interval <= 0 or _plan_expiry_thread is not None:
+        return
+
+    def run():
+        while True:
+            _sweeper_lease.wait()
+            try:
+                with app.app_context():
+                    expire_cancelled_plans()
+            except Exception as e:
+                print('Plan expiry failed:', e)
+            time.sleep(interval)
+
+    _plan_expiry_thread = threading.Thread(target=run, name='qr-plan-expiry', daemon=True)
+    _plan_expiry_thread.start()
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -440,39 +1185,29 @@ def stripe_success(plan):
 
 # Helper to generate qr code files
 
-def generate_qr_files(
-    url,
-    color='black',
-    bgcolor='white',
-    style='square',
-    gradient=False,
-    gradient_color=None,
-    user_id=None,
-    file_id=None,
-):
-    qr = qrcode.QRCode(
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=1,
-        border=4,
-    )
-    qr.add_data(url)
-    qr.make(fit=True)
+# Formats that can be rendered for every QR code
+QR_FORMATS = ('png', 'jpg', 'svg')
+# Formats rendered on demand into the render cache only
+CACHED_FORMATS = ('webp', 'avif') if features.check('avif') else ('webp',)
+DOWNLOAD_FORMATS = QR_FORMATS + CACHED_FORMATS
+# Formats that need the raster image (as opposed to the SVG writer)
+RASTER_FORMATS = ('png', 'jpg', 'webp', 'avif')
+# Part of every render cache key and stored file name; bumped whenever the
+# output of a format changes so that neither the cache, the stored files nor
+# ETags hand out the old output
+RENDER_VERSION = 5
+# Styled PNGs with at most this many colors are written as palette images.
+# Gradients have a few hundred; as palette images they are barely smaller,
+# sometimes larger, and take twice as long to encode.
+PNG_PALETTE_COLORS = 64
 
-    # Adjust box size so the final image fits within 400px.
-    max_pixels = 400
-    qr.box_size = max(1, max_pixels // qr.modules_count)
+# Render each format only when it is first requested instead of writing
+# PNG, JPG and SVG while the QR code is created.
+app.config['QR_LAZY_RENDER'] = os.environ.get('QR_LAZY_RENDER', '1').lower() not in ('0', 'false')
 
-    if style == 'rounded':
-        drawer = RoundedModuleDrawer()
-    elif style == 'circle':
-        drawer = CircleModuleDrawer()
-    elif style == 'vertical':
-        drawer = VerticalBarsDrawer()
-    elif style == 'horizontal':
-        drawer = HorizontalBarsDrawer()
-    else:
-        drawer = None
 
+def parse_qr_colors(color, bgcolor, gradient=False, gradient_color=None):
+    """Return RGB tuples for the given colors or raise ValueError."""
     try:
         front = ImageColor.getcolor(color, "RGB")
         back = ImageColor.getcolor(bgcolor, "RGB")
@@ -481,94 +1216,1340 @@ def generate_qr_files(
         )
     except ValueError as e:
         raise ValueError("Ungültige Farbe") from e
+    return front, back, grad
+
+
+# Error correction levels from the least to the most redundancy
+ERROR_CORRECTION_LEVELS = (
+    qrcode.constants.ERROR_CORRECT_L,
+    qrcode.constants.ERROR_CORRECT_M,
+    qrcode.constants.ERROR_CORRECT_Q,
+    qrcode.constants.ERROR_CORRECT_H,
+)
+# Minimum level per style. Plain squares read fine at M; rounded modules
+# lose their corners and circles and bars a good part of each module, so
+# they need more redundancy. Gradients lower the contrast and always get H.
+# There is no choice per content type: every code encodes the URL of its
+# show_qr page, whatever it was created for, so URL, text, e-mail, phone,
+# SMS and contact codes carry the same kind of payload.
+STYLE_ERROR_CORRECTION = {
+    'square': qrcode.constants.ERROR_CORRECT_M,
+    'rounded': qrcode.constants.ERROR_CORRECT_Q,
+    'circle': qrcode.constants.ERROR_CORRECT_H,
+    'vertical': qrcode.constants.ERROR_CORRECT_H,
+    'horizontal': qrcode.constants.ERROR_CORRECT_H,
+}
+# Versions sharing the same sizes of the segment length fields
+QR_VERSION_RANGES = ((1, 9), (10, 26), (27, 40))
+
+
+def qr_error_correction(style='square', gradient=False):
+    """Return the minimum error correction level for a style."""
+    if gradient:
+        return qrcode.constants.ERROR_CORRECT_H
+    return STYLE_ERROR_CORRECTION.get(style, qrcode.constants.ERROR_CORRECT_M)
+
+
+def qr_versions(data_list):
+    """Map each error correction level to the smallest version for data_list.
+
+    The segment bits are counted once; per level the version is looked up in
+    qrcode's capacity table. Levels the data does not fit map to None.
+    """
+    buffer = qrcode.util.BitBuffer()
+    for data in data_list:
+        data.write(buffer)
+    needed = []
+    for first, last in QR_VERSION_RANGES:
+        mode_sizes = qrcode.util.mode_sizes_for_version(first)
+        header = sum(4 + mode_sizes[data.mode] for data in data_list)
+        needed.append((first, last, len(buffer) + header))
+    versions = {}
+    for level in ERROR_CORRECTION_LEVELS:
+        limits = qrcode.util.BIT_LIMIT_TABLE[level]
+        versions[level] = next(
+            (
+                version
+                for first, last, bits in needed
+                for version in [bisect.bisect_left(limits, bits, first)]
+                if version <= last
+            ),
+            None,
+        )
+    return versions
+
+
+def build_qr(url, max_pixels=400, style='square', gradient=False):
+    """Return a QRCode object with its matrix already built.
+
+    The error correction level starts at the minimum for the style and is
+    raised as long as the data still fits the same version, so the extra
+    redundancy costs no modules.
+    """
+    qr = qrcode.QRCode(box_size=1, border=4)
+    qr.add_data(url)
+    level = qr_error_correction(style, gradient)
+    versions = qr_versions(qr.data_list)
+    if versions[level] is None:
+        # Too long even for version 40; qrcode reports the overflow
+        qr.error_correction = level
+        qr.make(fit=True)
+    else:
+        for higher in ERROR_CORRECTION_LEVELS[ERROR_CORRECTION_LEVELS.index(level) + 1:]:
+            if versions[higher] != versions[level]:
+                break
+            level = higher
+        qr.error_correction = level
+        qr.version = versions[level]
+        qr.make(fit=False)
+
+    # Adjust box size so the final image fits within max_pixels.
+    qr.box_size = max(1, max_pixels // qr.modules_count)
+    return qr
+
+
+def render_qr_image(qr, front, back, grad=None, style='square'):
+    """Rasterize an already built QR code with the given colors and style.
+
+    Plain square codes without a gradient take the fast matrix path; the
+    styled drawers are only used when they change the result.
+    """
+    if grad is None and style not in STYLED_DRAWERS:
+        return render_qr_matrix(qr, front, back)
+    return render_qr_styled(qr, front, back, grad, style)
+
 
-    if gradient and grad:
+# Module drawers for the styles that StyledPilImage has to render
+STYLED_DRAWERS = {
+    'rounded': RoundedModuleDrawer,
+    'circle': CircleModuleDrawer,
+    'vertical': VerticalBarsDrawer,
+    'horizontal': HorizontalBarsDrawer,
+}
+
+
+def render_qr_styled(qr, front, back, grad=None, style='square'):
+    """Rasterize with StyledPilImage, its module drawers and color masks."""
+    drawer_class = STYLED_DRAWERS.get(style)
+    drawer = drawer_class() if drawer_class else None
+
+    if grad:
         mask = VerticalGradiantColorMask(top_color=front, bottom_color=grad, back_color=back)
     else:
         mask = SolidFillColorMask(front_color=front, back_color=back)
 
-    img = qr.make_image(
+    return qr.make_image(
         image_factory=StyledPilImage,
         module_drawer=drawer,
         color_mask=mask,
+    ).get_image()
+
+
+def render_qr_matrix(qr, front, back):
+    """Rasterize a plain square code straight from its module matrix.
+
+    Builds a one pixel per module palette image and scales it with NEAREST,
+    which produces the same pixels as StyledPilImage for solid colors.
+    """
+    matrix = qr.get_matrix()
+    count = len(matrix)
+    img = Image.frombytes(
+        'P', (count, count), bytes(dark for row in matrix for dark in row)
     )
-    qr_id = file_id or os.urandom(8).hex()
-    user_folder = (
-        os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
-        if user_id
-        else app.config['UPLOAD_FOLDER']
-    )
-    os.makedirs(user_folder, exist_ok=True)
+    img.putpalette(back + front)
+    size = count * qr.box_size
+    return img.resize((size, size), Image.NEAREST)
 
-    png_path = os.path.join(user_folder, f'{qr_id}.png')
-    jpg_path = os.path.join(user_folder, f'{qr_id}.jpg')
-    svg_path = os.path.join(user_folder, f'{qr_id}.svg')
 
-    try:
-        img.save(png_path)
-        img.convert('RGB').save(jpg_path)
-        svg_img = qr.make_image(image_factory=qrcode.image.svg.SvgImage)
-        with open(svg_path, 'wb') as f:
-            svg_img.save(f)
-    except Exception as e:
-        raise IOError("Fehler beim Speichern der QR-Dateien") from e
+QR_STYLES = ('square', 'rounded', 'circle', 'vertical', 'horizontal')
 
-    return qr_id, png_path, jpg_path, svg_path
 
+def _hex_color(rgb):
+    return '#%02x%02x%02x' % rgb
 
-def enforce_qrcode_limit(user):
-    limit = PLAN_LIMITS.get(user.plan)
-    if limit is None:
-        return
-    qrs = QRCode.query.filter_by(user_id=user.id).order_by(QRCode.id).all()
-    excess = len(qrs) - limit
-    if excess > 0:
-        for qr in qrs[:excess]:
-            for path in [qr.png_path, qr.jpg_path, qr.svg_path]:
-                if path and os.path.exists(path):
-                    os.remove(path)
-            db.session.delete(qr)
-        db.session.commit()
 
+def _svg_square_runs(dark, border):
+    """Path of horizontal runs of dark squares, one subpath per run."""
+    parts = []
+    for y, row in enumerate(dark):
+        x = 0
+        while x < len(row):
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < len(row) and row[x]:
+                x += 1
+            parts.append(f'M{start + border} {y + border}h{x - start}v1h-{x - start}z')
+    return parts
 
-def cleanup_orphaned_qrcodes():
-    """Synchronize QR code files with database records."""
-    removed = False
 
-    # Delete database entries whose files are missing
-    for qr in QRCode.query.all():
-        paths = [qr.png_path, qr.jpg_path, qr.svg_path]
-        if not all(path and os.path.exists(path) for path in paths):
-            db.session.delete(qr)
-            removed = True
-    if removed:
-        db.session.commit()
+def _svg_bars(dark, active, border, vertical):
+    """Path of the bars drawn by HorizontalBarsDrawer or VerticalBarsDrawer.
 
-    # Collect paths that should exist according to the database
-    tracked_paths = set()
-    for qr in QRCode.query.all():
-        for p in (qr.png_path, qr.jpg_path, qr.svg_path):
-            if p:
-                tracked_paths.add(os.path.abspath(p))
-
-    # Remove files on disk that are not referenced in the database
-    for root_dir, _, files in os.walk(app.config['UPLOAD_FOLDER']):
-        for filename in files:
-            if filename.lower().endswith(('.png', '.jpg', '.svg')):
-                file_path = os.path.abspath(os.path.join(root_dir, filename))
-                if file_path not in tracked_paths:
-                    try:
-                        os.remove(file_path)
-                    except FileNotFoundError:
-                        pass
+    Bars are 0.8 modules thick with elliptic caps at ends without a dark
+    neighbor, like the raster drawers.
+    """
+    parts = []
+    count = len(dark)
+    for line in range(count):
+        pos = 0
+        while pos < count:
+            cell = (pos, line) if vertical else (line, pos)
+            if not dark[cell[0]][cell[1]]:
+                pos += 1
+                continue
+            start = pos
+            while pos < count and dark[pos if vertical else line][line if vertical else pos]:
+                pos += 1
+            before = start > 0 and active(*((start - 1, line) if vertical else (line, start - 1)))
+            after = pos < count and active(*((pos, line) if vertical else (line, pos)))
+            head = 0 if before else 0.5
+            tail = 0 if after else 0.5
+            length = f'{pos - start - head - tail:g}'
+            if vertical:
+                x, y = line + border + 0.1, start + border + head
+                parts.append(
+                    f'M{x:g} {y:g}'
+                    + ('a.4 .5 0 0 1 .8 0' if head else 'h.8')
+                    + f'v{length}'
+                    + ('a.4 .5 0 0 1 -.8 0' if tail else 'h-.8')
+                    + 'z'
+                )
+            else:
+                x, y = start + border + head, line + border + 0.1
+                parts.append(
+                    f'M{x:g} {y:g}h{length}'
+                    + ('a.5 .4 0 0 1 0 .8' if tail else 'v.8')
+                    + f'h-{length}'
+                    + ('a.5 .4 0 0 1 0 -.8' if head else 'v-.8')
+                    + 'z'
+                )
+    return parts
 
 
-def cancel_paypal_subscription(sub_id):
-    client_id = os.environ.get('PAYPAL_CLIENT_ID')
-    client_secret = os.environ.get('PAYPAL_CLIENT_SECRET')
-    base_url = os.environ.get('PAYPAL_BASE_URL', 'https://api-m.paypal.com')
-    if not (client_id and client_secret):
-        return
+def render_qr_svg(qr, front, back, grad=None, style='square'):
+    """Return the SVG of a built QR code as a single path.
+
+    Colors, the vertical gradient and the module drawers follow the raster
+    renderer: the finder patterns stay square and the other modules take
+    the shape of the style. Square modules are merged into horizontal runs.
+    """
+    modules = qr.modules
+    count = qr.modules_count
+    border = qr.border
+    size = count + 2 * border
+
+    def active(row, col):
+        return 0 <= row < count and 0 <= col < count and bool(modules[row][col])
+
+    def is_eye(row, col):
+        return (row < 7 and col < 7) or (row < 7 and col >= count - 7) or (row >= count - 7 and col < 7)
+
+    styled = style if style in STYLED_DRAWERS else None
+    squares = [[False] * count for _ in range(count)]
+    shaped = [[False] * count for _ in range(count)]
+    parts = []
+    for row in range(count):
+        for col in range(count):
+            if not modules[row][col]:
+                continue
+            if styled is None or is_eye(row, col):
+                squares[row][col] = True
+            elif styled == 'rounded':
+                corners = (
+                    not active(row - 1, col) and not active(row, col + 1),
+                    not active(row, col + 1) and not active(row + 1, col),
+                    not active(row + 1, col) and not active(row, col - 1),
+                    not active(row, col - 1) and not active(row - 1, col),
+                )
+                if not any(corners):
+                    squares[row][col] = True
+                    continue
+                ne, se, sw, nw = corners
+                parts.append(
+                    f'M{col + border + 0.5:g} {row + border}'
+                    + ('a.5 .5 0 0 1 .5 .5' if ne else 'h.5v.5')
+                    + ('a.5 .5 0 0 1 -.5 .5' if se else 'v.5h-.5')
+                    + ('a.5 .5 0 0 1 -.5 -.5' if sw else 'h-.5v-.5')
+                    + ('a.5 .5 0 0 1 .5 -.5' if nw else 'v-.5h.5')
+                    + 'z'
+                )
+            elif styled == 'circle':
+                parts.append(
+                    f'M{col + border} {row + border + 0.5:g}a.5 .5 0 1 0 1 0a.5 .5 0 1 0 -1 0z'
+                )
+            else:
+                shaped[row][col] = True
+    parts.extend(_svg_square_runs(squares, border))
+    if styled in ('horizontal', 'vertical'):
+        parts.extend(_svg_bars(shaped, active, border, styled == 'vertical'))
+
+    fill = _hex_color(front)
+    defs = ''
+    if grad:
+        # Same direction as VerticalGradiantColorMask: top to bottom edge
+        defs = (
+            f'<defs><linearGradient id="g" gradientUnits="userSpaceOnUse" x2="0" y2="{size}">'
+            f'<stop offset="0" stop-color="{fill}"/>'
+            f'<stop offset="1" stop-color="{_hex_color(grad)}"/></linearGradient></defs>'
+        )
+        fill = 'url(#g)'
+    pixels = size * qr.box_size
+    crisp = ' shape-rendering="crispEdges"' if styled is None else ''
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels}" '
+        f'viewBox="0 0 {size} {size}"{crisp}>{defs}'
+        f'<rect width="{size}" height="{size}" fill="{_hex_color(back)}"/>'
+        f'<path fill="{fill}" d="{"".join(parts)}"/></svg>\n'
+    ).encode('utf-8')
+
+
+class RenderCache:
+    """Two tier cache for rendered QR images.
+
+    Entries are kept in an in-process LRU bounded by ``memory_bytes`` and in
+    a sharded directory bounded by ``disk_bytes``. When the directory grows
+    beyond its limit the least recently used files are removed.
+    """
+
+    def __init__(self, folder, memory_bytes, disk_bytes):
+        self.folder = folder
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, key, fmt):
+        return os.path.join(self.folder, key[:2], f'{key}.{fmt}')
+
+    def get(self, key, fmt):
+        """Return cached bytes or None."""
+        with self._lock:
+            data = self._memory.get((key, fmt))
+            if data is not None:
+                self._memory.move_to_end((key, fmt))
+                self.memory_hits += 1
+                return data
+        path = self.path(key, fmt)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Refresh the modification time so eviction stays LRU.
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self._remember(key, fmt, data)
+        return data
+
+    def put(self, key, fmt, data):
+        """Store rendered bytes in both tiers."""
+        self._remember(key, fmt, data)
+        path = self.path(key, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = self._scan_disk_size()
+            else:
+                self._disk_size += len(data)
+            over_limit = self._disk_size > self.disk_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _remember(self, key, fmt, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop((key, fmt), None)
+            if old is not None:
+                self._memory_size -= len(old)
+            self._memory[(key, fmt)] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _iter_files(self):
+        if not os.path.isdir(self.folder):
+            return
+        for shard in os.scandir(self.folder):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file():
+                    yield entry
+
+    def _scan_disk_size(self):
+        return sum(entry.stat().st_size for entry in self._iter_files())
+
+    def _evict_disk(self):
+        """Remove least recently used files until 90% of the limit is reached."""
+        files = sorted(
+            ((e.stat().st_mtime, e.stat().st_size, e.path) for e in self._iter_files()),
+        )
+        total = sum(size for _, size, _ in files)
+        target = self.disk_bytes * 0.9
+        removed = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self._disk_size = total
+            self.evictions += removed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'memory_items': len(self._memory),
+                'memory_bytes': self._memory_size,
+            }
+
+
+render_cache = RenderCache(
+    app.config['RENDER_CACHE_FOLDER'],
+    app.config['RENDER_CACHE_MEMORY_BYTES'],
+    app.config['RENDER_CACHE_DISK_BYTES'],
+)
+
+
+def render_cache_key(
+    url,
+    color='black',
+    bgcolor='white',
+    style='square',
+    gradient=False,
+    gradient_color=None,
+    size=400,
+):
+    """Return a hash of the normalized render parameters.
+
+    The format is not part of the key; cache entries are stored per format.
+    """
+    front, back, grad = parse_qr_colors(color, bgcolor, gradient, gradient_color)
+    params = [
+        RENDER_VERSION,
+        url,
+        '#%02x%02x%02x' % front,
+        '#%02x%02x%02x' % back,
+        '#%02x%02x%02x' % grad if grad else None,
+        style if style in QR_STYLES else 'square',
+        size,
+        qr_error_correction(style, grad is not None),
+    ]
+    return hashlib.sha256(json.dumps(params).encode('utf-8')).hexdigest()
+
+
+def _save_png(img, buf):
+    """Save as a palette PNG where the colors allow it.
+
+    Plain codes come as two-color palette images, which Pillow writes with
+    one bit per pixel. Styled codes without a gradient only have a few
+    anti-aliasing shades; they get a palette of exactly those colors. The
+    quantizer is not guaranteed to keep every color, so the result is
+    compared with the original and RGB is written when they differ.
+    """
+    if img.mode != 'P':
+        img = img.convert('RGB')
+        colors = img.getcolors(PNG_PALETTE_COLORS)
+        if colors is not None:
+            palette = img.quantize(
+                colors=len(colors), method=Image.Quantize.MAXCOVERAGE, dither=Image.Dither.NONE
+            )
+            if ImageChops.difference(palette.convert('RGB'), img).getbbox() is None:
+                img = palette
+    img.save(buf, format='PNG')
+
+
+def _save_jpeg(img, buf):
+    """Save with optimized Huffman tables; same pixels, fewer bytes."""
+    try:
+        img.save(buf, format='JPEG', optimize=True)
+    except OSError:
+        # Pillow's output buffer for optimized JPEGs can be too small for
+        # large noisy images; the plain encoder streams instead
+        buf.seek(0)
+        buf.truncate()
+        img.save(buf, format='JPEG')
+
+
+def encode_qr_image(qr, img, fmt):
+    """Return the bytes of a built QR code in the given format."""
+    buf = io.BytesIO()
+    if fmt == 'png':
+        _save_png(img, buf)
+    elif fmt == 'jpg':
+        _save_jpeg(img.convert('RGB'), buf)
+    elif fmt == 'webp':
+        img.convert('RGB').save(buf, format='WEBP', lossless=True)
+    elif fmt == 'avif' and fmt in CACHED_FORMATS:
+        img.convert('RGB').save(buf, format='AVIF')
+    else:
+        raise ValueError(f'Unsupported format {fmt}')
+    return buf.getvalue()
+
+
+def render_qr_formats(
+    url,
+    color='black',
+    bgcolor='white',
+    style='square',
+    gradient=False,
+    gradient_color=None,
+    formats=QR_FORMATS,
+    size=400,
+):
+    """Return a dict mapping each format to its rendered bytes.
+
+    Formats already present in the render cache are not rendered again and
+    the matrix is built at most once for the remaining ones.
+    """
+    front, back, grad = parse_qr_colors(color, bgcolor, gradient, gradient_color)
+    key = render_cache_key(url, color, bgcolor, style, gradient, gradient_color, size)
+    result = {}
+    missing = []
+    for fmt in formats:
+        data = render_cache.get(key, fmt)
+        if data is None:
+            missing.append(fmt)
+        else:
+            result[fmt] = data
+    if not missing:
+        return result
+
+    with metrics.timer('qrcode_render_stage_duration_seconds', stage='matrix'):
+        qr = build_qr(url, size, style, grad is not None)
+    img = None
+    if any(fmt in RASTER_FORMATS for fmt in missing):
+        with metrics.timer('qrcode_render_stage_duration_seconds', stage='raster'):
+            img = render_qr_image(qr, front, back, grad, style)
+    for fmt in missing:
+        with metrics.timer('qrcode_render_stage_duration_seconds', stage=f'{fmt}_encode'):
+            if fmt == 'svg':
+                data = render_qr_svg(qr, front, back, grad, style)
+            else:
+                data = encode_qr_image(qr, img, fmt)
+        try:
+            render_cache.put(key, fmt, data)
+        except OSError as e:
+            print('Failed to store rendered QR code:', e)
+        result[fmt] = data
+    return result
+
+
+# Files live in two shard levels taken from the random file id, e.g.
+# ab/cd/abcd1234.png, so no folder grows beyond a few hundred entries and a
+# listing in name order follows the public id order.
+SHARD_ALPHABET = ''.join(sorted(string.ascii_lowercase + string.digits))
+SHARD_PREFIXES = tuple(a + b for a in SHARD_ALPHABET for b in SHARD_ALPHABET)
+
+
+def qr_file_name(file_id, fmt, version=RENDER_VERSION):
+    """Path of a QR image relative to the upload folder.
+
+    Rendered files carry the RENDER_VERSION they were written with, so files
+    of an older release are told apart and rendered again on access. Files
+    moved over from the per-user layout get the name without a version.
+    """
+    suffix = f'.v{version}' if version is not None else ''
+    return f'{file_id[:2]}/{file_id[2:4]}/{file_id}{suffix}.{fmt}'
+
+
+def qr_file_path(path, upload_folder=None):
+    """Absolute location of a stored file path.
+
+    Paths are stored relative to the upload folder. Codes that were not
+    moved to the sharded layout yet still hold absolute paths, which
+    os.path.join returns unchanged.
+    """
+    if not path:
+        return path
+    return os.path.join(upload_folder or app.config['UPLOAD_FOLDER'], path)
+
+
+def svgz_path(path):
+    """Location of the gzip compressed copy written next to an SVG file."""
+    return f'{path}z'
+
+
+def qr_file_copies(path):
+    """The file at path and the compressed copy that belongs to it, if any."""
+    return (path, svgz_path(path)) if path.endswith('.svg') else (path,)
+
+
+def generate_qr_files(
+    url,
+    color='black',
+    bgcolor='white',
+    style='square',
+    gradient=False,
+    gradient_color=None,
+    file_id=None,
+    formats=QR_FORMATS,
+    upload_folder=None,
+):
+    """Render the requested formats to disk.
+
+    Returns the file id followed by the PNG, JPG and SVG paths relative to
+    the upload folder. Paths of formats that were not requested are None.
+    """
+    upload_folder = upload_folder or app.config['UPLOAD_FOLDER']
+    rendered = render_qr_formats(
+        url,
+        color=color,
+        bgcolor=bgcolor,
+        style=style,
+        gradient=gradient,
+        gradient_color=gradient_color,
+        formats=formats,
+    )
+
+    qr_id = file_id or os.urandom(8).hex()
+    paths = {fmt: None for fmt in QR_FORMATS}
+    try:
+        with metrics.timer('qrcode_render_stage_duration_seconds', stage='disk_write'):
+            for fmt, data in rendered.items():
+                paths[fmt] = qr_file_name(qr_id, fmt)
+                target = os.path.join(upload_folder, paths[fmt])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    f.write(data)
+                if fmt == 'svg':
+                    # Served instead of the SVG to clients accepting gzip
+                    with open(svgz_path(target), 'wb') as f:
+                        f.write(gzip.compress(data, mtime=0))
+    except Exception as e:
+        raise IOError("Fehler beim Speichern der QR-Dateien") from e
+
+    return qr_id, paths['png'], paths['jpg'], paths['svg']
+
+
+def set_qr_path(qr, fmt, path):
+    """Store a new file path for fmt and queue the file it replaces."""
+    old = getattr(qr, f'{fmt}_path')
+    if old and old != path:
+        db.session.add(PendingDeletion(path=old))
+        db.session.info['pending_deletions'] = True
+    setattr(qr, f'{fmt}_path', path)
+
+
+def ensure_qr_file(qr, fmt):
+    """Return the file for fmt, rendering it from the stored spec if needed.
+
+    Files written by an older RENDER_VERSION are rendered again as well.
+    Codes created before the render spec was stored cannot be re-rendered;
+    their existing path is returned unchanged.
+    """
+    stored = getattr(qr, f'{fmt}_path')
+    path = qr_file_path(stored)
+    if not qr.payload:
+        return path
+    if stored == qr_file_name(qr.public_id, fmt) and os.path.exists(path):
+        return path
+    _, png_path, jpg_path, svg_path = generate_qr_files(
+        qr.payload,
+        color=qr.color,
+        bgcolor=qr.bgcolor,
+        style=qr.style,
+        gradient=qr.gradient,
+        gradient_color=qr.gradient_color,
+        file_id=qr.public_id,
+        formats=(fmt,),
+    )
+    path = {'png': png_path, 'jpg': jpg_path, 'svg': svg_path}[fmt]
+    set_qr_path(qr, fmt, path)
+    db.session.commit()
+    return qr_file_path(path)
+
+
+# Background rendering
+
+# Number of render worker processes per serving process. 0 renders
+# synchronously on first access. By default the CPU cores are split between
+# the workers of the server (gunicorn.conf.py exports their number).
+app.config['RENDER_WORKERS'] = int(
+    os.environ.get(
+        'RENDER_WORKERS',
+        str(max(1, (os.cpu_count() or 1) // int(os.environ.get('QRCODE_SERVER_WORKERS', '1')))),
+    )
+)
+# Formats rendered in the background right after a QR code is created
+app.config['RENDER_PREWARM_FORMATS'] = tuple(
+    fmt
+    for fmt in os.environ.get('RENDER_PREWARM_FORMATS', 'png').split(',')
+    if fmt in QR_FORMATS
+)
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    """Return the shared render process pool, creating it on first use."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # Spawned workers do not inherit locks held by request threads.
+            _render_pool = ProcessPoolExecutor(
+                max_workers=app.config['RENDER_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _render_pool
+
+
+def _render_worker(spec, formats, upload_folder):
+    """Render QR files inside a worker process.
+
+    Returns the paths and the render stage timings measured in the worker.
+    """
+    with metrics.capture() as timings:
+        _, png_path, jpg_path, svg_path = generate_qr_files(
+            spec['payload'],
+            color=spec['color'],
+            bgcolor=spec['bgcolor'],
+            style=spec['style'],
+            gradient=spec['gradient'],
+            gradient_color=spec['gradient_color'],
+            file_id=spec['public_id'],
+            formats=formats,
+            upload_folder=upload_folder,
+        )
+    return {'png': png_path, 'jpg': jpg_path, 'svg': svg_path}, timings
+
+
+def qr_render_spec(qr):
+    """Return the picklable render spec of a QR code."""
+    return {
+        'payload': qr.payload,
+        'color': qr.color,
+        'bgcolor': qr.bgcolor,
+        'style': qr.style,
+        'gradient': qr.gradient,
+        'gradient_color': qr.gradient_color,
+        'public_id': qr.public_id,
+    }
+
+
+def use_render_pool():
+    return app.config['RENDER_WORKERS'] > 0 and bool(app.config['RENDER_PREWARM_FORMATS'])
+
+
+def enqueue_render(qr, formats=None):
+    """Queue a background render job for qr and mark it as pending.
+
+    The caller is responsible for committing the session afterwards.
+    """
+    formats = tuple(formats or app.config['RENDER_PREWARM_FORMATS'])
+    job = RenderJob(qr_id=qr.id, formats=','.join(formats))
+    db.session.add(job)
+    qr.render_status = 'pending'
+    return job
+
+
+def submit_render_job(spec, formats):
+    """Hand a render spec to the process pool and return its future."""
+    return get_render_pool().submit(
+        _render_worker, spec, formats, app.config['UPLOAD_FOLDER']
+    )
+
+
+def render_future_result(future):
+    """Return (paths, error) of a finished render future.
+
+    Stage timings measured by the worker are added to the local metrics.
+    """
+    error = future.exception()
+    if error is not None:
+        return None, str(error) or error.__class__.__name__
+    paths, timings = future.result()
+    for name, value, labels in timings:
+        metrics.observe(name, value, **labels)
+    return paths, None
+
+
+def dispatch_render_jobs(jobs):
+    """Submit committed jobs to the worker pool."""
+    for job in jobs:
+        qr = db.session.get(QRCode, job.qr_id)
+        if qr is None:
+            continue
+        job_id = job.id
+        start_render_writer()
+        try:
+            future = submit_render_job(qr_render_spec(qr), tuple(job.formats.split(',')))
+        except Exception as e:
+            print('Failed to submit render job:', e)
+            _render_results.put((job_id, None, str(e)))
+            continue
+        # The callback runs on the pool's management thread and must not
+        # block it, so the database writes happen in the writer thread
+        future.add_done_callback(
+            lambda f, job_id=job_id: _render_results.put((job_id, *render_future_result(f)))
+        )
+
+
+def apply_render_result(job, qr, paths, error):
+    """Record the outcome of a render job on the session without committing."""
+    if error:
+        print('Render job failed:', error)
+        job.status = 'failed'
+        job.error = error[:255]
+        job.finished_at = datetime.utcnow()
+        if qr is not None:
+            qr.render_status = 'failed'
+        return
+    # Finished jobs are not kept; failed ones stay for inspection.
+    db.session.delete(job)
+    if qr is not None:
+        for fmt, path in paths.items():
+            if path:
+                set_qr_path(qr, fmt, path)
+        qr.render_status = 'done'
+
+
+# Finished render jobs as (job_id, paths, error), stored by the writer thread
+_render_results = queue.Queue()
+RENDER_RESULT_BATCH = 100
+_render_writer_thread = None
+_render_writer_lock = threading.Lock()
+
+
+def store_render_results(results):
+    """Store the outcome of finished render jobs in one transaction."""
+    with app.app_context():
+        jobs = RenderJob.query.filter(RenderJob.id.in_([r[0] for r in results])).all()
+        qrs = {
+            qr.id: qr
+            for qr in QRCode.query.filter(QRCode.id.in_([job.qr_id for job in jobs]))
+        }
+        outcomes = {job_id: (paths, error) for job_id, paths, error in results}
+        for job in jobs:
+            apply_render_result(job, qrs.get(job.qr_id), *outcomes[job.id])
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print('Failed to store render job results:', e)
+
+
+def _drain_render_results():
+    results = []
+    while len(results) < RENDER_RESULT_BATCH:
+        try:
+            results.append(_render_results.get_nowait())
+        except queue.Empty:
+            break
+    return results
+
+
+def start_render_writer():
+    """Start the thread that stores render results, once per process."""
+    global _render_writer_thread
+    with _render_writer_lock:
+        if _render_writer_thread is not None:
+            return
+
+        def run():
+            while True:
+                results = [_render_results.get()] + _drain_render_results()
+                try:
+                    store_render_results(results)
+                except Exception as e:
+                    print('Failed to store render job results:', e)
+
+        def flush():
+            results = _drain_render_results()
+            while results:
+                store_render_results(results)
+                results = _drain_render_results()
+
+        atexit.register(flush)
+        _render_writer_thread = threading.Thread(
+            target=run, name='qr-render-writer', daemon=True
+        )
+        _render_writer_thread.start()
+
+
+def resume_render_jobs():
+    """Re-submit jobs that were queued when the application stopped."""
+    jobs = RenderJob.query.filter_by(status='queued').all()
+    if jobs and use_render_pool():
+        dispatch_render_jobs(jobs)
+
+
+# Deletion
+#
+# Requests only delete rows: the file paths of the deleted codes are copied
+# into pending_deletion with INSERT ... SELECT, the rows go with one bulk
+# DELETE and a background sweeper unlinks the files afterwards.
+
+app.config['SWEEP_INTERVAL'] = float(os.environ.get('SWEEP_INTERVAL', '30'))
+
+
+def mark_qrcodes_deleted(*criteria):
+    """Bulk delete the QR codes matching criteria and queue their files.
+
+    Returns the number of deleted codes. The caller commits.
+    """
+    selected = select(QRCode.id).where(*criteria)
+    public_ids = db.session.execute(
+        select(QRCode.public_id).where(QRCode.id.in_(selected))
+    ).scalars().all()
+    if not public_ids:
+        return 0
+    for fmt in QR_FORMATS:
+        column = getattr(QRCode, f'{fmt}_path')
+        db.session.execute(
+            db.insert(PendingDeletion).from_select(
+                ['path'],
+                select(column).where(QRCode.id.in_(selected), column.isnot(None)),
+            )
+        )
+    db.session.execute(db.delete(RenderJob).where(RenderJob.qr_id.in_(selected)))
+    db.session.execute(db.delete(ScanHourly).where(ScanHourly.public_id.in_(
+        select(QRCode.public_id).where(QRCode.id.in_(selected))
+    )))
+    deleted = db.session.execute(
+        db.delete(QRCode)
+        .where(QRCode.id.in_(selected))
+        .execution_options(synchronize_session='fetch')
+    ).rowcount
+    # Bulk deletes bypass the mapper hooks that maintain the rollups
+    upsert_increment(db.session.connection(), StatsCounter, {'name': 'qrcodes'}, {'value': -deleted})
+    for public_id in public_ids:
+        file_index.invalidate(public_id)
+        scan_index.invalidate(public_id)
+    db.session.info['pending_deletions'] = True
+    return deleted
+
+
+def sweep_pending_deletions(batch_size=500):
+    """Remove queued files. Returns the number of entries handled."""
+    handled = 0
+    while True:
+        batch = PendingDeletion.query.order_by(PendingDeletion.id).limit(batch_size).all()
+        if not batch:
+            return handled
+        for entry in batch:
+            for copy in qr_file_copies(qr_file_path(entry.path)):
+                try:
+                    os.remove(copy)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # Left for the reconciler, which removes unreferenced files
+                    print('Failed to remove file:', copy, e)
+        db.session.execute(
+            db.delete(PendingDeletion).where(PendingDeletion.id <= batch[-1].id)
+        )
+        db.session.commit()
+        handled += len(batch)
+
+
+_sweeper_wakeup = threading.Event()
+_sweeper_thread = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_deletion_sweeper(session):
+    if session.info.pop('pending_deletions', False):
+        _sweeper_wakeup.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_pending_deletions(session):
+    session.info.pop('pending_deletions', None)
+
+
+def start_deletion_sweeper():
+    """Sweep queued deletions in a daemon thread after commits or periodically."""
+    global _sweeper_thread
+    if _sweeper_thread is not None:
+        return
+
+    def run():
+        while True:
+            _sweeper_wakeup.wait(app.config['SWEEP_INTERVAL'])
+            _sweeper_wakeup.clear()
+            _sweeper_lease.wait()
+            try:
+                with app.app_context():
+                    sweep_pending_deletions()
+            except Exception as e:
+                print('Deletion sweep failed:', e)
+
+    _sweeper_thread = threading.Thread(target=run, name='qr-deletion-sweeper', daemon=True)
+    _sweeper_thread.start()
+
+
+@app.cli.command('sweep-deletions')
+def sweep_deletions_command():
+    """Remove all files queued for deletion now."""
+    click.echo(f'{sweep_pending_deletions()} entries removed')
+
+
+def enforce_qrcode_limit(user):
+    limit = PLAN_LIMITS.get(user.plan)
+    if limit is None:
+        return
+    excess = count_user_qrcodes(user.id) - limit
+    if excess > 0:
+        oldest = (
+            select(QRCode.id)
+            .where(QRCode.user_id == user.id)
+            .order_by(QRCode.id)
+            .limit(excess)
+        )
+        mark_qrcodes_deleted(QRCode.id.in_(oldest))
+        db.session.commit()
+
+
+# Orphan reconciliation
+#
+# The reconciler walks the shard folders in name order. For each first-level
+# shard the stored file names of the codes whose public id starts with it
+# are merged with a sorted listing of its files: stored files that are
+# missing are forgotten (codes with a render spec) or deleted together with
+# their row (legacy codes), files nobody references are removed. A
+# checkpoint in JobCheckpoint lets the background thread resume with the
+# next batch of shards.
+
+app.config['RECONCILE_INTERVAL'] = float(os.environ.get('RECONCILE_INTERVAL', '3600'))
+app.config['RECONCILE_BATCH_SHARDS'] = int(os.environ.get('RECONCILE_BATCH_SHARDS', '16'))
+# Files younger than this may belong to a render that is not committed yet
+app.config['RECONCILE_GRACE_SECONDS'] = float(os.environ.get('RECONCILE_GRACE_SECONDS', '600'))
+
+RECONCILE_PAUSE = 1.0
+QR_FILE_SUFFIXES = tuple(f'.{fmt}' for fmt in QR_FORMATS)
+RECONCILE_COLUMNS = (
+    QRCode.id,
+    QRCode.public_id,
+    QRCode.payload,
+    QRCode.png_path,
+    QRCode.jpg_path,
+    QRCode.svg_path,
+)
+# Rows fetched per round trip while a shard is read; only the rows whose
+# stored paths lie in the shard are kept for the merge
+RECONCILE_YIELD_ROWS = 1000
+
+
+def new_reconcile_report():
+    return {'folders': 0, 'cleared': [], 'deleted': {}, 'orphans': []}
+
+
+def merge_reconcile_report(total, part):
+    total['folders'] += part['folders']
+    total['cleared'].extend(part['cleared'])
+    total['deleted'].update(part['deleted'])
+    total['orphans'].extend(part['orphans'])
+
+
+def _list_shard_files(upload_folder, prefix):
+    """Sorted (relative path, mtime) pairs of the QR files below one shard."""
+    files = []
+    try:
+        with os.scandir(os.path.join(upload_folder, prefix)) as shards:
+            subfolders = [entry.name for entry in shards if entry.is_dir()]
+    except FileNotFoundError:
+        return files
+    for name in subfolders:
+        with os.scandir(os.path.join(upload_folder, prefix, name)) as entries:
+            files.extend(
+                (f'{prefix}/{name}/{entry.name}', entry.stat().st_mtime) for entry in entries
+                if entry.name.lower().endswith(QR_FILE_SUFFIXES) and entry.is_file()
+            )
+    files.sort()
+    return files
+
+
+def _record_missing(row, fmt, report):
+    if row.payload:
+        report['cleared'].append((row.id, row.public_id, fmt))
+    else:
+        report['deleted'][row.id] = row.public_id
+
+
+def _reconcile_shard(upload_folder, prefix, rows, report):
+    """Merge the stored file names of rows with the files below prefix."""
+    report['folders'] += 1
+    expected = []
+    for row in rows:
+        for fmt in QR_FORMATS:
+            path = getattr(row, f'{fmt}_path')
+            if not path:
+                continue
+            if path.startswith(f'{prefix}/'):
+                expected.append((path, row, fmt))
+            elif not os.path.exists(qr_file_path(path, upload_folder)):
+                # Paths of the old per-user layout are checked one by one
+                _record_missing(row, fmt, report)
+    expected.sort(key=lambda item: item[0])
+    files = _list_shard_files(upload_folder, prefix)
+    cutoff = time.time() - app.config['RECONCILE_GRACE_SECONDS']
+    i = j = 0
+    while i < len(expected) or j < len(files):
+        if j == len(files) or (i < len(expected) and expected[i][0] < files[j][0]):
+            _record_missing(expected[i][1], expected[i][2], report)
+            i += 1
+        elif i == len(expected) or files[j][0] < expected[i][0]:
+            name, mtime = files[j]
+            if mtime < cutoff:
+                report['orphans'].append(os.path.join(upload_folder, name))
+            j += 1
+        else:
+            name = files[j][0]
+            while i < len(expected) and expected[i][0] == name:
+                i += 1
+            j += 1
+
+
+def _apply_reconcile_report(report, batch_size=500):
+    """Remove orphaned files and update the rows of missing files."""
+    for path in report['orphans']:
+        for copy in qr_file_copies(path):
+            try:
+                os.remove(copy)
+            except FileNotFoundError:
+                pass
+    for fmt in QR_FORMATS:
+        ids = [qr_id for qr_id, _, cleared_fmt in report['cleared'] if cleared_fmt == fmt]
+        for offset in range(0, len(ids), batch_size):
+            db.session.execute(
+                update(QRCode)
+                .where(QRCode.id.in_(ids[offset:offset + batch_size]))
+                .values({f'{fmt}_path': None})
+            )
+    deleted = list(report['deleted'])
+    for offset in range(0, len(deleted), batch_size):
+        for qr in QRCode.query.filter(QRCode.id.in_(deleted[offset:offset + batch_size])):
+            db.session.delete(qr)
+    db.session.commit()
+    for _, public_id, _ in report['cleared']:
+        file_index.invalidate(public_id)
+    for public_id in report['deleted'].values():
+        file_index.invalidate(public_id)
+
+
+def reconcile_chunk(start=None, max_shards=None, dry_run=False):
+    """Reconcile max_shards first-level shards beginning at index start.
+
+    Each shard is matched against the codes whose public id starts with its
+    name, streamed with yield_per from one range query on the public id
+    index. Returns the index to continue with, or None once the cycle is
+    complete, together with the report of this chunk.
+    """
+    start = start or 0
+    end = start + (max_shards or app.config['RECONCILE_BATCH_SHARDS'])
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    report = new_reconcile_report()
+    for index in range(start, min(end, len(SHARD_PREFIXES))):
+        prefix = SHARD_PREFIXES[index]
+        conditions = [QRCode.public_id >= prefix]
+        if index + 1 < len(SHARD_PREFIXES):
+            conditions.append(QRCode.public_id < SHARD_PREFIXES[index + 1])
+        rows = db.session.execute(
+            select(*RECONCILE_COLUMNS)
+            .where(*conditions)
+            .execution_options(yield_per=RECONCILE_YIELD_ROWS)
+        )
+        _reconcile_shard(upload_folder, prefix, rows, report)
+    if not dry_run:
+        _apply_reconcile_report(report)
+    return (end if end < len(SHARD_PREFIXES) else None), report
+
+
+def reconcile_qrcodes(dry_run=False):
+    """Run a complete reconciliation cycle and return the merged report."""
+    total = new_reconcile_report()
+    position = None
+    while True:
+        position, report = reconcile_chunk(position, dry_run=dry_run)
+        merge_reconcile_report(total, report)
+        if position is None:
+            return total
+
+
+def cleanup_orphaned_qrcodes():
+    """Synchronize QR code files with database records."""
+    return reconcile_qrcodes()
+
+
+def reconcile_step():
+    """Reconcile the next batch of shards and store the checkpoint.
+
+    Returns the new checkpoint, None once a full cycle has finished.
+    """
+    checkpoint = db.session.get(JobCheckpoint, 'reconcile')
+    position, _ = reconcile_chunk(checkpoint.position if checkpoint else None)
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name='reconcile')
+        db.session.add(checkpoint)
+    checkpoint.position = position
+    db.session.commit()
+    return position
+
+
+_reconciler_thread = None
+
+
+def start_reconciler():
+    """Run reconcile_step() in a daemon thread, pausing between cycles."""
+    global _reconciler_thread
+    interval = app.config['RECONCILE_INTERVAL']
+    if interval <= 0 or _reconciler_thread is not None:
+        return
+
+    def run():
+        while True:
+            _sweeper_lease.wait()
+            try:
+                with app.app_context():
+                    position = reconcile_step()
+            except Exception as e:
+                print('Reconciliation failed:', e)
+                position = None
+            time.sleep(RECONCILE_PAUSE if position is not None else interval)
+
+    _reconciler_thread = threading.Thread(target=run, name='qr-reconciler', daemon=True)
+    _reconciler_thread.start()
+
+
+@app.cli.command('reconcile')
+@click.option('--dry-run', is_flag=True, help='Only report what would change.')
+def reconcile_command(dry_run):
+    """Reconcile the QR code files with the database in one full pass."""
+    report = reconcile_qrcodes(dry_run=dry_run)
+    prefix = 'Would ' if dry_run else ''
+    for _, public_id, fmt in report['cleared']:
+        click.echo(f'{prefix}forget missing {fmt.upper()} of {public_id}')
+    for public_id in report['deleted'].values():
+        click.echo(f'{prefix}delete {public_id} (files missing)')
+    for path in report['orphans']:
+        click.echo(f'{prefix}remove orphaned file {path}')
+    click.echo(
+        f"{report['folders']} folders checked, {len(report['cleared'])} missing files, "
+        f"{len(report['deleted'])} codes deleted, {len(report['orphans'])} orphaned files"
+    )
+
+
+def _move_to_shard(qr, upload_folder):
+    """Move the files of qr from the per-user layout into its shard."""
+    for fmt in QR_FORMATS:
+        path = getattr(qr, f'{fmt}_path')
+        if not path or not os.path.isabs(path):
+            continue
+        name = qr_file_name(qr.public_id, fmt, version=None)
+        target = os.path.join(upload_folder, name)
+        if os.path.exists(path):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        elif not os.path.exists(target):
+            # Rendered again on demand for codes with a stored spec
+            name = None if qr.payload else path
+        setattr(qr, f'{fmt}_path', name)
+
+
+def _remove_legacy_folders(upload_folder):
+    """Remove QR files left in the upload root and the per-user folders."""
+    removed = 0
+    with os.scandir(upload_folder) as entries:
+        folders = [upload_folder] + [
+            entry.path for entry in entries if entry.is_dir() and entry.name.isdigit()
+        ]
+    for folder in folders:
+        with os.scandir(folder) as entries:
+            names = [
+                entry.path for entry in entries
+                if entry.name.lower().endswith(QR_FILE_SUFFIXES) and entry.is_file()
+            ]
+        for path in names:
+            os.remove(path)
+            removed += 1
+        if folder != upload_folder:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+    return removed
+
+
+def migrate_file_layout(batch_size=500, echo=print):
+    """Move QR files from per-user folders into the sharded layout.
+
+    Progress is stored in the 'file-layout' checkpoint after every batch,
+    so an interrupted run continues where it stopped.
+    """
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    checkpoint = db.session.get(JobCheckpoint, 'file-layout')
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name='file-layout', position=0)
+        db.session.add(checkpoint)
+    moved = 0
+    while True:
+        batch = (
+            QRCode.query.filter(QRCode.id > checkpoint.position)
+            .order_by(QRCode.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        for qr in batch:
+            if any(
+                path and os.path.isabs(path)
+                for path in (qr.png_path, qr.jpg_path, qr.svg_path)
+            ):
+                _move_to_shard(qr, upload_folder)
+                file_index.invalidate(qr.public_id)
+                moved += 1
+        checkpoint.position = batch[-1].id
+        db.session.commit()
+        echo(f'{moved} codes moved, checkpoint {checkpoint.position}')
+    removed = _remove_legacy_folders(upload_folder)
+    db.session.delete(checkpoint)
+    db.session.commit()
+    echo(f'{moved} codes moved, {removed} unreferenced files removed')
+    return moved
+
+
+@app.cli.command('migrate-files')
+@click.option('--batch-size', default=500, show_default=True, help='Codes per commit.')
+def migrate_files_command(batch_size):
+    """Move the QR code files into the sharded folder layout."""
+    migrate_file_layout(batch_size, echo=click.echo)
+
+
+def cancel_paypal_subscription(sub_id):
+    client_id = os.environ.get('PAYPAL_CLIENT_ID')
+    client_secret = os.environ.get('PAYPAL_CLIENT_SECRET')
+    base_url = os.environ.get('PAYPAL_BASE_URL', 'https://api-m.paypal.com')
+    if not (client_id and client_secret):
+        return
     try:
         auth = requests.post(
             f"{base_url}/v1/oauth2/token",
@@ -626,6 +2607,111 @@ def calculate_prorated_credit(user):
     credit = latest_payment.amount * (remaining_seconds / (86400 * total_days))
     return int(round(credit))
 
+def qr_fields_from_form(form):
+    """Return the QRCode fields described by a form or bulk import row."""
+    data_type = form.get('data_type') or 'url'
+    if data_type == 'url':
+        data_input = form.get('url')
+    elif data_type == 'text':
+        data_input = form.get('text')
+    elif data_type == 'email':
+        data_input = 'mailto:' + (form.get('email') or '')
+    elif data_type == 'phone':
+        data_input = 'tel:' + (form.get('phone') or '')
+    elif data_type == 'sms':
+        phone = form.get('sms_phone') or ''
+        msg = form.get('sms_message') or ''
+        data_input = f'SMSTO:{phone}:{msg}'
+    elif data_type == 'contact':
+        name = form.get('contact_name') or ''
+        phone = form.get('contact_phone') or ''
+        email = form.get('contact_email') or ''
+        data_input = (
+            'BEGIN:VCARD\nVERSION:3.0\n'
+            f'FN:{name}\nTEL:{phone}\nEMAIL:{email}\nEND:VCARD'
+        )
+    else:
+        data_input = form.get('url')
+    gradient = str(form.get('gradient') or '').lower() in ('on', '1', 'true', 'yes')
+    return {
+        'url': data_input,
+        'data_type': data_type,
+        'description': form.get('description'),
+        'color': form.get('color') or 'black',
+        'bgcolor': form.get('bgcolor') or 'white',
+        'style': form.get('style') or 'square',
+        'gradient': gradient,
+        'gradient_color': form.get('gradcolor'),
+    }
+
+
+def new_qrcode(user, fields):
+    """Return a new, unsaved QRCode for user. Raises ValueError on bad colors.
+
+    Must be called inside a request context so the public link can be built.
+    """
+    parse_qr_colors(
+        fields['color'], fields['bgcolor'], fields['gradient'], fields['gradient_color']
+    )
+    public_id = generate_public_id()
+    return QRCode(
+        public_id=public_id,
+        user_id=user.id,
+        payload=url_for('show_qr', qr_id=public_id, _external=True),
+        **fields,
+    )
+
+
+# Pagination
+
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', '50'))
+
+
+def count_user_qrcodes(user_id):
+    """Number of QR codes owned by user_id, counted in the database."""
+    return db.session.query(func.count(QRCode.id)).filter(QRCode.user_id == user_id).scalar()
+
+
+def keyset_page(query, column, after=None, before=None, per_page=None):
+    """Return (items, prev_cursor, next_cursor) for one page ordered by column.
+
+    Cursors are values of column: ``after`` continues behind a row and
+    ``before`` pages back in front of one. Only per_page + 1 rows are read.
+    """
+    per_page = per_page or app.config['PAGE_SIZE']
+    if before is not None:
+        rows = query.filter(column < before).order_by(column.desc()).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        prev_cursor = getattr(items[0], column.key) if has_more else None
+        # The page came from behind items[-1]; ``before`` itself would skip
+        # the row that follows it
+        next_cursor = getattr(items[-1], column.key) if items else None
+    else:
+        if after is not None:
+            query = query.filter(column > after)
+        rows = query.order_by(column).limit(per_page + 1).all()
+        items = rows[:per_page]
+        prev_cursor = getattr(items[0], column.key) if after is not None and items else None
+        next_cursor = getattr(items[-1], column.key) if len(rows) > per_page else None
+    return items, prev_cursor, next_cursor
+
+
+def page_args():
+    """Read the after/before cursors and the page size from the query string."""
+    per_page = request.args.get('limit', type=int) or app.config['PAGE_SIZE']
+    return {
+        'after': request.args.get('after', type=int),
+        'before': request.args.get('before', type=int),
+        'per_page': max(1, min(per_page, app.config['PAGE_SIZE'] * 4)),
+    }
+
+
+def qrcode_page(user_id):
+    """One keyset page of the QR codes owned by user_id."""
+    return keyset_page(QRCode.query.filter_by(user_id=user_id), QRCode.id, **page_args())
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -633,64 +2719,32 @@ def index():
             flash('Bitte einloggen um QR-Codes zu speichern.', 'danger')
             return redirect(url_for('index'))
         limit = PLAN_LIMITS.get(current_user.plan)
-        if limit is not None and len(current_user.qrcodes) >= limit:
+        if limit is not None and count_user_qrcodes(current_user.id) >= limit:
             flash('Limit für deinen Plan erreicht.', 'warning')
             return redirect(url_for('index'))
-        data_type = request.form.get('data_type', 'url')
-        if data_type == 'url':
-            data_input = request.form.get('url')
-        elif data_type == 'text':
-            data_input = request.form.get('text')
-        elif data_type == 'email':
-            data_input = 'mailto:' + request.form.get('email', '')
-        elif data_type == 'phone':
-            data_input = 'tel:' + request.form.get('phone', '')
-        elif data_type == 'sms':
-            phone = request.form.get('sms_phone', '')
-            msg = request.form.get('sms_message', '')
-            data_input = f'SMSTO:{phone}:{msg}'
-        elif data_type == 'contact':
-            name = request.form.get('contact_name', '')
-            phone = request.form.get('contact_phone', '')
-            email = request.form.get('contact_email', '')
-            data_input = (
-                'BEGIN:VCARD\nVERSION:3.0\n'
-                f'FN:{name}\nTEL:{phone}\nEMAIL:{email}\nEND:VCARD'
-            )
-        else:
-            data_input = request.form.get('url')
-        color = request.form.get('color', 'black')
-        bgcolor = request.form.get('bgcolor', 'white')
-        style = request.form.get('style', 'square')
-        gradient = request.form.get('gradient') == 'on'
-        grad_color = request.form.get('gradcolor')
-        description = request.form.get('description')
+        fields = qr_fields_from_form(request.form)
         try:
-            public_id = generate_public_id()
-            qr = QRCode(
-                public_id=public_id,
-                url=data_input,
-                data_type=data_type,
-                description=description,
-                user=current_user,
-            )
+            qr = new_qrcode(current_user, fields)
             db.session.add(qr)
             db.session.flush()
-            qr_link = url_for('show_qr', qr_id=qr.public_id, _external=True)
-            _, png_path, jpg_path, svg_path = generate_qr_files(
-                qr_link,
-                color=color,
-                bgcolor=bgcolor,
-                style=style,
-                gradient=gradient,
-                gradient_color=grad_color,
-                user_id=current_user.id,
-                file_id=qr.public_id,
-            )
-            qr.png_path = png_path
-            qr.jpg_path = jpg_path
-            qr.svg_path = svg_path
+            jobs = []
+            if use_render_pool():
+                jobs.append(enqueue_render(qr))
+            elif not app.config['QR_LAZY_RENDER']:
+                _, png_path, jpg_path, svg_path = generate_qr_files(
+                    qr.payload,
+                    color=qr.color,
+                    bgcolor=qr.bgcolor,
+                    style=qr.style,
+                    gradient=qr.gradient,
+                    gradient_color=qr.gradient_color,
+                    file_id=qr.public_id,
+                )
+                qr.png_path = png_path
+                qr.jpg_path = jpg_path
+                qr.svg_path = svg_path
             db.session.commit()
+            dispatch_render_jobs(jobs)
             flash('QR-Code erstellt!', 'success')
         except Exception as e:
             db.session.rollback()
@@ -698,10 +2752,10 @@ def index():
             print('QR creation failed:', e)
         return redirect(url_for('index'))
 
-    qrs = (
-        QRCode.query.filter_by(user_id=current_user.id).all()
+    qrs, prev_cursor, next_cursor = (
+        qrcode_page(current_user.id)
         if current_user.is_authenticated
-        else []
+        else ([], None, None)
     )
     limit = (
         PLAN_LIMITS.get(current_user.plan)
@@ -710,67 +2764,820 @@ def index():
     )
     remaining = None
     if current_user.is_authenticated and limit is not None:
-        remaining = max(0, limit - len(qrs))
+        remaining = max(0, limit - count_user_qrcodes(current_user.id))
     limit_reached = remaining == 0 if remaining is not None else False
     return render_template(
         'index.html',
         qrcodes=qrs,
+        scans=scan_totals([qr.public_id for qr in qrs]),
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
         limit_reached=limit_reached,
         remaining=remaining,
         limit=limit,
     )
 
+
+def qrcode_json(qr):
+    return {
+        'id': qr.public_id,
+        'url': qr.url,
+        'data_type': qr.data_type,
+        'description': qr.description,
+        'created_at': qr.created_at.isoformat() if qr.created_at else None,
+        'render_status': qr.render_status,
+        'preview': url_for('preview', qr_id=qr.public_id, v=qr.render_version),
+        'show': url_for('show_qr', qr_id=qr.public_id),
+    }
+
+
+@app.route('/api/qrcodes')
+@login_required
+def api_qrcodes():
+    """List the QR codes of the current user (admins may pass user_id)."""
+    user_id = current_user.id
+    if request.args.get('user_id') and is_admin():
+        user_id = request.args.get('user_id', type=int)
+    qrs, prev_cursor, next_cursor = qrcode_page(user_id)
+    return {
+        'items': [qrcode_json(qr) for qr in qrs],
+        'prev_cursor': prev_cursor,
+        'next_cursor': next_cursor,
+    }
+
+# Bulk creation
+
+BULK_BATCH_SIZE = 500
+
+
+def read_bulk_rows(stream, fmt):
+    """Return an iterator over the import rows of a CSV or JSON text stream.
+
+    CSV columns and JSON keys use the same names as the creation form. JSON
+    is parsed right away, so malformed files raise ValueError here and not
+    while the progress is already being streamed.
+    """
+    if fmt == 'json':
+        return bulk_rows_from_json(json.load(stream))
+    return csv.DictReader(stream)
+
+
+def bulk_rows_from_json(data):
+    """Return import rows from a parsed JSON list or ``{"codes": [...]}``.
+
+    Raises ValueError for any other shape.
+    """
+    if isinstance(data, dict):
+        data = data.get('codes') or []
+    if not isinstance(data, list):
+        raise ValueError('Erwartet wird eine Liste oder {"codes": [...]}')
+    # A plain list of strings is treated as a list of URLs
+    return ({'url': row} if isinstance(row, str) else row for row in data)
+
+
+def bulk_row_fields(row):
+    """Return the QRCode fields of an import row, None if it is malformed.
+
+    JSON rows may hold numbers or booleans, which are read like form text.
+    """
+    if not isinstance(row, dict) or any(isinstance(v, (list, dict)) for v in row.values()):
+        return None
+    return qr_fields_from_form(
+        {key: value if value is None or isinstance(value, str) else str(value)
+         for key, value in row.items()}
+    )
+
+
+def bulk_create_qrcodes(user, rows, batch_size=BULK_BATCH_SIZE):
+    """Create QR codes for user from rows and yield progress dicts.
+
+    Rows are inserted in batched transactions and rendered on the process
+    pool. Rows beyond the plan limit are skipped. The last dict has
+    ``stage == 'done'`` and reports the elapsed time and codes per second.
+    Must be called inside a request context.
+    """
+    start = time.perf_counter()
+    limit = PLAN_LIMITS.get(user.plan)
+    remaining = None
+    if limit is not None:
+        remaining = max(0, limit - QRCode.query.filter_by(user_id=user.id).count())
+    progress = {'stage': 'insert', 'created': 0, 'rendered': 0, 'failed': 0,
+                'skipped': 0, 'errors': []}
+    render = use_render_pool()
+    pending = {}
+    batch = []
+
+    def insert_batch():
+        db.session.add_all(batch)
+        db.session.flush()
+        submissions = []
+        if render:
+            jobs = [enqueue_render(qr) for qr in batch]
+            db.session.flush()
+            submissions = [
+                (job.id, qr_render_spec(qr), tuple(job.formats.split(',')))
+                for job, qr in zip(jobs, batch)
+            ]
+        db.session.commit()
+        for job_id, spec, formats in submissions:
+            pending[submit_render_job(spec, formats)] = job_id
+        progress['created'] += len(batch)
+        batch.clear()
+
+    def store_results(futures):
+        job_ids = [pending.pop(f) for f in futures]
+        results = dict(zip(job_ids, (render_future_result(f) for f in futures)))
+        jobs = RenderJob.query.filter(RenderJob.id.in_(job_ids)).all()
+        qrs = {
+            qr.id: qr
+            for qr in QRCode.query.filter(QRCode.id.in_([j.qr_id for j in jobs]))
+        }
+        for job in jobs:
+            paths, error = results[job.id]
+            apply_render_result(job, qrs.get(job.qr_id), paths, error)
+            progress['failed' if error else 'rendered'] += 1
+        db.session.commit()
+
+    for number, row in enumerate(rows, start=1):
+        if remaining is not None and progress['created'] + len(batch) >= remaining:
+            progress['skipped'] += 1
+            continue
+        fields = bulk_row_fields(row)
+        if fields is None:
+            progress['errors'].append(f'Zeile {number}: ungültiger Eintrag')
+            continue
+        if not fields['url']:
+            progress['errors'].append(f'Zeile {number}: kein Inhalt')
+            continue
+        try:
+            batch.append(new_qrcode(user, fields))
+        except ValueError as e:
+            progress['errors'].append(f'Zeile {number}: {e}')
+            continue
+        if len(batch) >= batch_size:
+            insert_batch()
+            done = [f for f in pending if f.done()]
+            if done:
+                store_results(done)
+            yield dict(progress)
+    if batch:
+        insert_batch()
+        yield dict(progress)
+
+    progress['stage'] = 'render'
+    finished = []
+    for future in as_completed(list(pending)):
+        finished.append(future)
+        if len(finished) >= batch_size:
+            store_results(finished)
+            finished = []
+            yield dict(progress)
+    if finished:
+        store_results(finished)
+
+    elapsed = time.perf_counter() - start
+    progress['stage'] = 'done'
+    progress['seconds'] = round(elapsed, 3)
+    progress['codes_per_sec'] = round(progress['created'] / elapsed, 1) if elapsed else 0.0
+    yield progress
+
+
+@app.route('/bulk', methods=['POST'])
+@login_required
+def bulk_create():
+    """Create many QR codes from an uploaded CSV/JSON file or a JSON body.
+
+    Progress is streamed as one JSON object per line.
+    """
+    upload = request.files.get('file')
+    try:
+        if upload:
+            fmt = 'json' if upload.filename.lower().endswith('.json') else 'csv'
+            rows = read_bulk_rows(io.TextIOWrapper(upload.stream, encoding='utf-8-sig'), fmt)
+        elif request.is_json:
+            rows = bulk_rows_from_json(request.get_json())
+        else:
+            return 'Keine Datei übergeben', 400
+    except ValueError as e:
+        return f'Ungültige Datei: {e}', 400
+    user = current_user._get_current_object()
+
+    def generate():
+        for progress in bulk_create_qrcodes(user, rows):
+            yield json.dumps(progress) + '\n'
+
+    return app.response_class(
+        stream_with_context(generate()), mimetype='application/x-ndjson'
+    )
+
+
+@app.cli.command('bulk-create')
+@click.argument('username')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--base-url',
+    default=lambda: os.environ.get('PUBLIC_BASE_URL', 'http://localhost:8010'),
+    help='Public URL of the application used for the encoded links.',
+)
+@click.option('--batch-size', default=BULK_BATCH_SIZE, show_default=True)
+def bulk_create_command(username, path, base_url, batch_size):
+    """Create QR codes for USERNAME from a CSV or JSON file."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'Unknown user {username}')
+    fmt = 'json' if path.lower().endswith('.json') else 'csv'
+    with open(path, encoding='utf-8-sig', newline='') as f, \
+            app.test_request_context(base_url=base_url):
+        try:
+            rows = read_bulk_rows(f, fmt)
+        except ValueError as e:
+            raise click.ClickException(f'Invalid file: {e}')
+        for progress in bulk_create_qrcodes(user, rows, batch_size):
+            click.echo(
+                f"[{progress['stage']}] created={progress['created']} "
+                f"rendered={progress['rendered']} failed={progress['failed']} "
+                f"skipped={progress['skipped']} errors={len(progress['errors'])}"
+            )
+    for error in progress['errors']:
+        click.echo(error, err=True)
+    click.echo(
+        f"{progress['created']} codes in {progress['seconds']}s "
+        f"({progress['codes_per_sec']} codes/sec)"
+    )
+
+
+# Scan resolver
+#
+# Printed codes point at /qr/<public_id>, by far the busiest route. Each
+# process keeps the resolved response of recently scanned codes: a redirect
+# target for URL codes and the rendered page for all other types. Hits are
+# answered without a database query or template rendering.
+
+app.config['SCAN_CACHE_SECONDS'] = float(os.environ.get('SCAN_CACHE_SECONDS', '300'))
+app.config['SCAN_CACHE_SIZE'] = int(os.environ.get('SCAN_CACHE_SIZE', '100000'))
+
+
+class ScanIndex:
+    """In-process map from public id to the resolved scan response.
+
+    Entries are ``(kind, value)`` pairs: ``('redirect', url)``,
+    ``('html', body)`` or ``('missing', None)`` for unknown ids. They are
+    dropped when a code is created, changed or deleted in this process and
+    expire after SCAN_CACHE_SECONDS otherwise.
+    """
+
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, public_id):
+        with self._lock:
+            entry = self._entries.get(public_id)
+            if entry is None:
+                return None
+            expires, resolved = entry
+            if expires <= time.monotonic():
+                del self._entries[public_id]
+                return None
+            self._entries.move_to_end(public_id)
+            return resolved
+
+    def put(self, public_id, resolved):
+        ttl = app.config['SCAN_CACHE_SECONDS']
+        if ttl > 0:
+            with self._lock:
+                self._entries[public_id] = (time.monotonic() + ttl, resolved)
+                self._entries.move_to_end(public_id)
+                while len(self._entries) > self.max_items:
+                    self._entries.popitem(last=False)
+        return resolved
+
+    def invalidate(self, public_id):
+        with self._lock:
+            self._entries.pop(public_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+scan_index = ScanIndex(app.config['SCAN_CACHE_SIZE'])
+
+
+@event.listens_for(QRCode, 'after_insert')
+@event.listens_for(QRCode, 'after_update')
+@event.listens_for(QRCode, 'after_delete')
+def _forget_scan(mapper, connection, target):
+    scan_index.invalidate(target.public_id)
+
+
+def parse_vcard(text):
+    """Return name, phone and email of a contact code."""
+    vcard = {'name': '', 'phone': '', 'email': ''}
+    for line in text.splitlines():
+        if line.startswith('FN:'):
+            vcard['name'] = line[3:]
+        elif line.startswith('TEL:'):
+            vcard['phone'] = line[4:]
+        elif line.startswith('EMAIL:'):
+            vcard['email'] = line[6:]
+    return vcard
+
+
+def render_scan_page(qr):
+    """Render the page shown when qr is scanned."""
+    vcard = parse_vcard(qr.url or '') if qr.data_type == 'contact' else None
+    return render_template('qr_view.html', qr=qr, vcard=vcard)
+
+
+def resolve_scan(qr_id):
+    """Look up qr_id and build the response entry stored in the scan index."""
+    qr = QRCode.query.filter_by(public_id=qr_id).first()
+    if qr is None:
+        return ('missing', None)
+    if qr.data_type == 'url' and qr.url:
+        return ('redirect', qr.url)
+    # Pages are stored as seen by anonymous visitors, so they are rendered
+    # in a context of their own without the session of this request
+    with app.app_context(), app.test_request_context(
+        f'/qr/{qr_id}', base_url=request.url_root
+    ):
+        return ('html', render_scan_page(qr).encode())
+
+
+# Scan analytics
+#
+# Scans are appended to a bounded in-process buffer; when it is full the
+# oldest entries are dropped rather than slowing down the resolver. A
+# background thread writes the buffer to scan_event in batches and adds
+# the same batch to the hourly counters per code and in total.
+
+app.config['SCAN_BUFFER_SIZE'] = int(os.environ.get('SCAN_BUFFER_SIZE', '100000'))
+app.config['SCAN_FLUSH_INTERVAL'] = float(os.environ.get('SCAN_FLUSH_INTERVAL', '5'))
+# Days single scan events are kept (0 = forever); hourly counters stay
+app.config['SCAN_EVENT_DAYS'] = int(os.environ.get('SCAN_EVENT_DAYS', '90'))
+
+SCAN_FLUSH_BATCH = 1000
+SCAN_PRUNE_INTERVAL = 3600
+# Substrings of the user agent mapped to the stored device class, in order
+SCAN_DEVICES = (
+    ('bot', 'bot'),
+    ('spider', 'bot'),
+    ('crawl', 'bot'),
+    ('android', 'android'),
+    ('iphone', 'ios'),
+    ('ipad', 'ios'),
+    ('windows', 'windows'),
+    ('mac os', 'mac'),
+    ('linux', 'linux'),
+)
+
+_scan_buffer = deque(maxlen=app.config['SCAN_BUFFER_SIZE'])
+_scan_flusher_thread = None
+
+
+def scan_device(user_agent):
+    """Coarse device class of a user agent string."""
+    user_agent = (user_agent or '').lower()
+    for needle, device in SCAN_DEVICES:
+        if needle in user_agent:
+            return device
+    return 'other'
+
+
+def referrer_host(referrer):
+    """Host name of a referrer URL; paths and queries are not stored."""
+    try:
+        host = urlsplit(referrer or '').hostname
+    except ValueError:
+        return None
+    return host[:255] if host else None
+
+
+def record_scan(public_id):
+    """Queue a scan of public_id for the flusher."""
+    if len(_scan_buffer) == _scan_buffer.maxlen:
+        metrics.inc('qrcode_scans_dropped_total')
+    _scan_buffer.append((
+        public_id,
+        datetime.utcnow(),
+        scan_device(request.headers.get('User-Agent')),
+        referrer_host(request.referrer),
+    ))
+
+
+def flush_scans(batch_size=SCAN_FLUSH_BATCH):
+    """Write the buffered scans and their counters. Returns the number written."""
+    written = 0
+    while True:
+        batch = []
+        try:
+            while len(batch) < batch_size:
+                batch.append(_scan_buffer.popleft())
+        except IndexError:
+            pass
+        if not batch:
+            return written
+        db.session.execute(db.insert(ScanEvent), [
+            {'public_id': public_id, 'created_at': created_at, 'device': device, 'referrer': referrer}
+            for public_id, created_at, device, referrer in batch
+        ])
+        connection = db.session.connection()
+        per_code = Counter((public_id, _hour(created_at)) for public_id, created_at, _, _ in batch)
+        for (public_id, bucket), count in per_code.items():
+            upsert_increment(
+                connection, ScanHourly, {'public_id': public_id, 'bucket': bucket}, {'count': count}
+            )
+        for bucket, count in Counter(_hour(created_at) for _, created_at, _, _ in batch).items():
+            upsert_increment(connection, StatsHourly, {'kind': 'scans', 'bucket': bucket}, {'count': count})
+        db.session.commit()
+        metrics.inc('qrcode_scans_recorded_total', len(batch))
+        written += len(batch)
+
+
+def prune_scan_events(batch_size=5000):
+    """Delete scan events older than SCAN_EVENT_DAYS. Returns the number removed."""
+    days = app.config['SCAN_EVENT_DAYS']
+    if days <= 0:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    removed = 0
+    while True:
+        expired = select(ScanEvent.id).where(ScanEvent.created_at < cutoff).limit(batch_size)
+        deleted = db.session.execute(
+            db.delete(ScanEvent).where(ScanEvent.id.in_(expired))
+        ).rowcount
+        db.session.commit()
+        removed += deleted
+        if deleted < batch_size:
+            return removed
+
+
+def start_scan_flusher():
+    """Flush buffered scans in a daemon thread and once more at exit."""
+    global _scan_flusher_thread
+    if _scan_flusher_thread is not None:
+        return
+
+    def flush():
+        try:
+            with app.app_context():
+                flush_scans()
+        except Exception as e:
+            print('Scan flush failed:', e)
+
+    def run():
+        pruned_at = 0.0
+        while True:
+            time.sleep(app.config['SCAN_FLUSH_INTERVAL'])
+            flush()
+            if time.monotonic() - pruned_at >= SCAN_PRUNE_INTERVAL:
+                pruned_at = time.monotonic()
+                try:
+                    with app.app_context():
+                        prune_scan_events()
+                except Exception as e:
+                    print('Scan pruning failed:', e)
+
+    atexit.register(flush)
+    _scan_flusher_thread = threading.Thread(target=run, name='qr-scan-flusher', daemon=True)
+    _scan_flusher_thread.start()
+
+
 @app.route('/qr/<string:qr_id>')
 def show_qr(qr_id):
-    qr = QRCode.query.filter_by(public_id=qr_id).first()
-    if qr is None:
+    resolved = scan_index.get(qr_id)
+    if resolved is None:
+        resolved = scan_index.put(qr_id, resolve_scan(qr_id))
+    kind, value = resolved
+    if kind == 'missing':
         flash('Dieser QR-Code ist nicht mehr aktuell.', 'danger')
         return redirect(url_for('index'))
-    vcard = None
-    if qr.data_type == 'contact':
-        vcard = {'name': '', 'phone': '', 'email': ''}
-        for line in qr.url.splitlines():
-            if line.startswith('FN:'):
-                vcard['name'] = line[3:]
-            elif line.startswith('TEL:'):
-                vcard['phone'] = line[4:]
-            elif line.startswith('EMAIL:'):
-                vcard['email'] = line[6:]
-    return render_template('qr_view.html', qr=qr, vcard=vcard)
+    record_scan(qr_id)
+    if kind == 'redirect':
+        return redirect(value)
+    if '_user_id' in session:
+        # Logged in visitors get their own navigation bar
+        qr = QRCode.query.filter_by(public_id=qr_id).first_or_404()
+        return render_scan_page(qr)
+    return app.response_class(value, mimetype='text/html')
+
+
+class FileIndex:
+    """In-process map from public id and format to the file that is served.
+
+    Repeated preview and download requests are answered without a database
+    query, and conditional requests without touching the disk. Entries are
+    dropped when a code is deleted or its file disappears.
+    """
+
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, public_id, fmt):
+        with self._lock:
+            formats = self._entries.get(public_id)
+            if formats is None:
+                return None
+            self._entries.move_to_end(public_id)
+            return formats.get(fmt)
+
+    def put(self, qr, fmt, path, etag_key=None, rendered=False):
+        """Remember the file of qr for fmt and return the new entry.
+
+        ``fmt`` may name a variant such as ``webp@128``; ``etag_key`` is the
+        render hash of that variant when it differs from the full image.
+        ``rendered`` marks files in the render cache, which may be evicted
+        and rendered again.
+        """
+        key = qr.render_key
+        etag_key = etag_key or key
+        gzip_path = svgz_path(path) if path.endswith('.svg') else None
+        entry = {
+            'path': path,
+            'name': qr.public_id + os.path.splitext(path)[1],
+            'gzip_path': gzip_path if gzip_path and os.path.exists(gzip_path) else None,
+            'user_id': qr.user_id,
+            'etag': f'{etag_key}-{fmt}' if etag_key else None,
+            'version': key[:12] if key else None,
+            'rendered': rendered,
+        }
+        with self._lock:
+            self._entries.setdefault(qr.public_id, {})[fmt] = entry
+            self._entries.move_to_end(qr.public_id)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, public_id):
+        with self._lock:
+            self._entries.pop(public_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+file_index = FileIndex()
+
+
+def send_qr_file(entry, as_attachment=False, private=False):
+    """Send an indexed QR file with ETag and Cache-Control headers.
+
+    Requests carrying the current version token (``?v=``) may be cached
+    forever; all others must revalidate with the ETag. SVGs are sent from
+    their precompressed copy to clients that accept gzip.
+    """
+    path, etag = entry['path'], entry['etag']
+    gzipped = bool(entry.get('gzip_path')) and 'gzip' in request.accept_encodings
+    if gzipped:
+        path = entry['gzip_path']
+        etag = f'{etag}-gzip' if etag else None
+    if etag and etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+    else:
+        response = send_file(
+            path,
+            mimetype='image/svg+xml' if gzipped else None,
+            as_attachment=as_attachment,
+            download_name=entry['name'],
+            etag=etag or True,
+        )
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    if entry.get('gzip_path'):
+        response.vary.add('Accept-Encoding')
+    scope = 'private' if private else 'public'
+    if entry['version'] and request.args.get('v') == entry['version']:
+        response.headers['Cache-Control'] = f'{scope}, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = f'{scope}, no-cache'
+    return response
+
+
+def indexed_qr_file(qr, fmt, variant=None):
+    """Render fmt for qr if necessary and return its file index entry.
+
+    ``variant`` indexes the file under another key, e.g. the stored PNG of a
+    code without render spec under the preview variant it stands in for.
+    """
+    try:
+        path = ensure_qr_file(qr, fmt)
+    except (ValueError, IOError) as e:
+        print('QR rendering failed:', e)
+        return None
+    if not path:
+        return None
+    return file_index.put(qr, variant or fmt, path)
+
+
+# Thumbnail edge lengths accepted by /preview?size=
+PREVIEW_SIZES = (128, 256)
+# Preview formats offered by Accept, smallest output first
+PREVIEW_FORMATS = ('webp', 'avif')
+
+
+def client_accepts(mimetype):
+    """Return True if the Accept header names mimetype explicitly."""
+    return any(value == mimetype for value, _ in request.accept_mimetypes)
+
+
+def preview_format():
+    """Return the smallest preview format the client accepts."""
+    for fmt in PREVIEW_FORMATS:
+        if fmt in CACHED_FORMATS and client_accepts(f'image/{fmt}'):
+            return fmt
+    return 'png'
+
+
+def indexed_render(qr, fmt, size=None):
+    """Render fmt through the render cache and index its file.
+
+    Returns None for codes without a stored spec; those only have the
+    files written when they were created.
+    """
+    if not qr.payload:
+        return None
+    spec = (qr.payload, qr.color, qr.bgcolor, qr.style, qr.gradient, qr.gradient_color)
+    sized = {'size': size} if size else {}
+    try:
+        data = render_qr_formats(*spec, formats=(fmt,), **sized)[fmt]
+        key = render_cache_key(*spec, **sized)
+        path = render_cache.path(key, fmt)
+        if not os.path.exists(path):
+            # Served from memory but evicted from disk
+            render_cache.put(key, fmt, data)
+    except (ValueError, IOError) as e:
+        print('QR rendering failed:', e)
+        return None
+    variant = f'{fmt}@{size}' if size else fmt
+    return file_index.put(qr, variant, path, etag_key=key, rendered=True)
+
 
 @app.route('/preview/<string:qr_id>')
 def preview(qr_id):
-    qr = QRCode.query.filter_by(public_id=qr_id).first_or_404()
-    directory = os.path.dirname(qr.png_path)
-    filename = os.path.basename(qr.png_path)
+    size = request.args.get('size', type=int)
+    if size is not None and size not in PREVIEW_SIZES:
+        return 'Unsupported size', 400
+    fmt = preview_format()
+    variant = f'{fmt}@{size}' if size else fmt
+    entry = file_index.get(qr_id, variant)
+    if entry is None:
+        qr = QRCode.query.filter_by(public_id=qr_id).first_or_404()
+        png_path = qr_file_path(qr.png_path)
+        if qr.render_status == 'pending' and not (png_path and os.path.exists(png_path)):
+            # Rendering is still queued; show a placeholder until it finishes.
+            response = send_from_directory(app.static_folder, 'qr_pending.svg')
+            response.status_code = 202
+            response.headers['Retry-After'] = '1'
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        if variant == 'png':
+            entry = indexed_qr_file(qr, 'png')
+        else:
+            # Codes without a stored spec fall back to their full size PNG
+            entry = indexed_render(qr, fmt, size) or indexed_qr_file(qr, 'png', variant)
+        if entry is None:
+            flash('Datei nicht gefunden', 'danger')
+            return redirect(url_for('index'))
     try:
-        return send_from_directory(directory, filename)
+        response = send_qr_file(entry)
     except FileNotFoundError:
+        file_index.invalidate(qr_id)
+        if entry['rendered']:
+            # Evicted from the render cache; the next request renders again
+            return redirect(request.full_path)
         flash('Datei nicht gefunden', 'danger')
         return redirect(url_for('index'))
+    response.vary.add('Accept')
+    return response
 
 @app.route('/download/<string:qr_id>/<fmt>')
 @login_required
 def download(qr_id, fmt):
-    qr = QRCode.query.filter_by(public_id=qr_id).first_or_404()
-    if qr.user_id != current_user.id:
-        return 'Unauthorized', 403
-    if fmt == 'png':
-        path = qr.png_path
-    elif fmt == 'jpg':
-        path = qr.jpg_path
-    elif fmt == 'svg':
-        path = qr.svg_path
-    else:
+    if fmt not in DOWNLOAD_FORMATS:
         return 'Unsupported format', 400
-    directory = os.path.dirname(path)
-    filename = os.path.basename(path)
+    entry = file_index.get(qr_id, fmt)
+    if entry is None:
+        qr = QRCode.query.filter_by(public_id=qr_id).first_or_404()
+        if qr.user_id != current_user.id:
+            return 'Unauthorized', 403
+        if fmt in QR_FORMATS:
+            entry = indexed_qr_file(qr, fmt)
+        else:
+            entry = indexed_render(qr, fmt)
+        if entry is None:
+            flash('Datei nicht gefunden', 'danger')
+            return redirect(url_for('index'))
+    elif entry['user_id'] != current_user.id:
+        return 'Unauthorized', 403
     try:
-        return send_from_directory(directory, filename, as_attachment=True)
+        return send_qr_file(entry, as_attachment=True, private=True)
     except FileNotFoundError:
+        file_index.invalidate(qr_id)
+        if entry['rendered']:
+            return redirect(request.full_path)
         flash('Datei nicht gefunden', 'danger')
         return redirect(url_for('index'))
 
+# Plans that may download all of their QR codes as one ZIP archive
+ZIP_EXPORT_PLANS = ('premium', 'unlimited')
+
+
+class ZipStream:
+    """Write-only file object that hands out what ZipFile has written so far.
+
+    ZipFile falls back to data descriptors for unseekable outputs, so the
+    archive can be sent while it is being built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_user_qrcodes(user_id, batch_size=100):
+    """Yield a user's QR codes ordered by id without loading all of them."""
+    last_id = 0
+    while True:
+        batch = (
+            QRCode.query.filter(QRCode.user_id == user_id, QRCode.id > last_id)
+            .order_by(QRCode.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            return
+        for qr in batch:
+            last_id = qr.id
+            yield qr
+
+
+@app.route('/download/all.zip')
+@login_required
+def download_all():
+    if current_user.plan not in ZIP_EXPORT_PLANS:
+        flash('Der ZIP-Export ist ab dem Premium-Plan verfügbar.', 'warning')
+        return redirect(url_for('upgrade'))
+    formats = [
+        fmt for fmt in request.args.get('fmt', 'png').split(',') if fmt in QR_FORMATS
+    ]
+    if not formats:
+        return 'Unsupported format', 400
+    user_id = current_user.id
+
+    def generate():
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w') as zf:
+            for qr in iter_user_qrcodes(user_id):
+                public_id = qr.public_id
+                for fmt in formats:
+                    try:
+                        path = ensure_qr_file(qr, fmt)
+                    except (ValueError, IOError) as e:
+                        print('QR rendering failed:', e)
+                        continue
+                    if not path or not os.path.exists(path):
+                        continue
+                    info = zipfile.ZipInfo(
+                        f'{public_id}.{fmt}', time.localtime(os.path.getmtime(path))[:6]
+                    )
+                    # PNG and JPG are already compressed
+                    info.compress_type = (
+                        zipfile.ZIP_DEFLATED if fmt == 'svg' else zipfile.ZIP_STORED
+                    )
+                    with open(path, 'rb') as src, zf.open(info, 'w') as dest:
+                        while True:
+                            chunk = src.read(64 * 1024)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            yield stream.pop()
+                    yield stream.pop()
+        yield stream.pop()
+
+    response = app.response_class(
+        stream_with_context(generate()), mimetype='application/zip'
+    )
+    response.headers['Content-Disposition'] = 'attachment; filename=qrcodes.zip'
+    return response
+
+
 @app.route('/delete/<string:qr_id>', methods=['POST'])
 @login_required
 def delete(qr_id):
@@ -780,14 +3587,8 @@ def delete(qr_id):
     if qr.created_at and datetime.utcnow() - qr.created_at < DELETE_GRACE_PERIOD:
         flash('QR-Code kann erst nach 14 Tagen gelöscht werden', 'warning')
         return redirect(url_for('index'))
-    for path in [qr.png_path, qr.jpg_path, qr.svg_path]:
-        if path and os.path.exists(path):
-            try:
-                os.remove(path)
-            except OSError:
-                flash('Datei konnte nicht entfernt werden', 'danger')
     try:
-        db.session.delete(qr)
+        mark_qrcodes_deleted(QRCode.id == qr.id)
         db.session.commit()
     except Exception:
         db.session.rollback()
@@ -806,70 +3607,250 @@ def is_admin():
 def admin_panel():
     if not is_admin():
         return 'Unauthorized', 403
-    users = User.query.all()
+    users, prev_cursor, next_cursor = keyset_page(User.query, User.id, **page_args())
+    qr_counts = dict(
+        db.session.query(QRCode.user_id, func.count(QRCode.id))
+        .filter(QRCode.user_id.in_([u.id for u in users]))
+        .group_by(QRCode.user_id)
+    )
     total_qrcodes = QRCode.query.count()
-    return render_template('admin.html', users=users, total_qrcodes=total_qrcodes)
+    return render_template(
+        'admin.html',
+        users=users,
+        qr_counts=qr_counts,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        total_qrcodes=total_qrcodes,
+    )
 
 
-@app.route('/admin/stats')
+def metrics_access_allowed():
+    """Admins and scrapers presenting METRICS_TOKEN may read metrics."""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and secrets.compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {token}'
+    ):
+        return True
+    return is_admin()
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_access_allowed():
+        return 'Unauthorized', 403
+    cache = render_cache.stats()
+    gauges = {
+        'qrcode_render_cache_memory_hits': cache['memory_hits'],
+        'qrcode_render_cache_disk_hits': cache['disk_hits'],
+        'qrcode_render_cache_misses': cache['misses'],
+        'qrcode_render_cache_evictions': cache['evictions'],
+        'qrcode_render_cache_memory_bytes': cache['memory_bytes'],
+    }
+    return app.response_class(
+        metrics.render(gauges), mimetype='text/plain; version=0.0.4'
+    )
+
+
+@app.route('/metrics/slow')
+def metrics_slow():
+    if not metrics_access_allowed():
+        return 'Unauthorized', 403
+    return app.response_class(profiler.report(), mimetype='text/plain')
+
+
+@app.route('/metrics/profile', methods=['POST'])
 @login_required
-def admin_stats():
+def metrics_profile():
+    """Switch the sampling profiler on or off (``enabled=1`` / ``0``)."""
     if not is_admin():
         return 'Unauthorized', 403
-    return render_template('admin_stats.html')
+    if request.form.get('enabled') == '1':
+        profiler.enable()
+    else:
+        profiler.disable()
+    return redirect(url_for('metrics_slow'))
 
 
-@app.route('/admin/stats/data')
+@app.route('/admin/stats')
 @login_required
-def admin_stats_data():
+def admin_stats():
     if not is_admin():
         return 'Unauthorized', 403
+    return render_template('admin_stats.html')
+
+
+# Seconds the admin statistics payload is served from memory
+app.config['STATS_CACHE_SECONDS'] = int(os.environ.get('STATS_CACHE_SECONDS', '30'))
+
+_stats_cache = {}
+_stats_cache_lock = threading.Lock()
+
+
+def hour_bucket(column):
+    """SQL expression truncating a timestamp column to 'YYYY-MM-DD HH'."""
+    if db.engine.dialect.name == 'postgresql':
+        return func.to_char(func.date_trunc('hour', column), 'YYYY-MM-DD HH24')
+    return func.strftime('%Y-%m-%d %H', column)
+
+
+def month_bucket(column):
+    """SQL expression truncating a timestamp column to 'YYYY-MM'."""
+    if db.engine.dialect.name == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+
+# Ranges offered on the statistics page: (bucket count, bucket unit)
+STATS_RANGES = {
+    '24h': (24, 'hour'),
+    '30d': (30, 'day'),
+    '12m': (12, 'month'),
+}
+
+
+def _bucket_starts(now, count, unit):
+    """Return the start of the last count hours, days or months.
+
+    Hours are complete ones; the last day and month are the running ones.
+    """
+    if unit == 'hour':
+        end = now.replace(minute=0, second=0, microsecond=0)
+        return [end - timedelta(hours=count - i) for i in range(count)]
+    if unit == 'day':
+        end = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        return [end - timedelta(days=count - i) for i in range(count)]
+    month_index = now.year * 12 + now.month - 1
+    return [
+        datetime(index // 12, index % 12 + 1, 1)
+        for index in range(month_index - count + 1, month_index + 1)
+    ]
+
+
+def _bucket_label(start, unit):
+    if unit == 'hour':
+        return (start + timedelta(hours=1)).strftime('%H')
+    if unit == 'day':
+        return start.strftime('%d.%m.')
+    return start.strftime('%m/%Y')
+
+
+def _bucket_key(value, unit):
+    if unit == 'hour':
+        return value
+    if unit == 'day':
+        return value.replace(hour=0)
+    return value.replace(day=1, hour=0)
+
+
+def compute_admin_stats(stats_range='24h'):
+    """Read the dashboard figures from the rollup tables."""
+    count, unit = STATS_RANGES[stats_range]
     now = datetime.utcnow()
-    one_day = now - timedelta(days=1)
-    day_labels = []
-    user_counts = []
-    qr_counts = []
-    for i in range(24):
-        hour = (one_day + timedelta(hours=i+1)).replace(minute=0, second=0, microsecond=0)
-        label = hour.strftime('%H')
-        day_labels.append(label)
-        uc = db.session.query(func.count(User.id)).filter(User.created_at >= hour - timedelta(hours=1), User.created_at < hour).scalar()
-        qc = db.session.query(func.count(QRCode.id)).filter(QRCode.created_at >= hour - timedelta(hours=1), QRCode.created_at < hour).scalar()
-        user_counts.append(uc or 0)
-        qr_counts.append(qc or 0)
-
-    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    month_revenue = db.session.query(func.sum(Payment.amount)).filter(Payment.created_at >= month_start).scalar() or 0
-    monthly_subs = db.session.query(func.count(Payment.id)).filter(Payment.period == 'month').scalar() or 0
-    yearly_subs = db.session.query(func.count(Payment.id)).filter(Payment.period == 'year').scalar() or 0
-
-    total_users = User.query.count()
-    total_qrcodes = QRCode.query.count()
-    total_revenue = db.session.query(func.sum(Payment.amount)).scalar() or 0
+    starts = _bucket_starts(now, count, unit)
+    series = {'signups': Counter(), 'qrcodes': Counter(), 'scans': Counter()}
+    # Rows of the running hour fall outside the hourly starts and are skipped;
+    # the daily and monthly ranges end with the running day or month
+    for row in StatsHourly.query.filter(StatsHourly.bucket >= starts[0]):
+        series[row.kind][_bucket_key(row.bucket, unit)] += row.count
+
+    months = {row.month: row for row in RevenueMonthly.query.order_by(RevenueMonthly.month)}
+    month_starts = _bucket_starts(now, 12, 'month')
+    current = months.get(now.strftime('%Y-%m'))
+
     active_subs = db.session.query(func.count(User.id)).filter(
         User.plan != 'basic',
         User.plan_cancelled.is_(False),
-        User.plan_expires_at > datetime.utcnow(),
+        User.plan_expires_at > now,
     ).scalar() or 0
-    plan_counts = dict(
-        db.session.query(User.plan, func.count(User.id)).group_by(User.plan).all()
-    )
+    plan_counts = {row.plan: row.users for row in PlanCount.query if row.users}
+    total_qrcodes = db.session.get(StatsCounter, 'qrcodes')
+    top_scans = db.session.query(
+        ScanHourly.public_id, func.sum(ScanHourly.count).label('scans')
+    ).filter(ScanHourly.bucket >= starts[0]).group_by(ScanHourly.public_id).order_by(
+        db.desc('scans')
+    ).limit(10).all()
 
     return {
-        'hours': day_labels,
-        'user_counts': user_counts,
-        'qr_counts': qr_counts,
-        'monthly_subs': monthly_subs,
-        'yearly_subs': yearly_subs,
-        'month_revenue': month_revenue / 100.0,
-        'total_users': total_users,
-        'total_qrcodes': total_qrcodes,
-        'total_revenue': total_revenue / 100.0,
+        'range': stats_range,
+        'unit': unit,
+        'labels': [_bucket_label(start, unit) for start in starts],
+        'user_counts': [series['signups'][start] for start in starts],
+        'qr_counts': [series['qrcodes'][start] for start in starts],
+        'scan_counts': [series['scans'][start] for start in starts],
+        'top_scans': [[public_id, int(scans)] for public_id, scans in top_scans],
+        'revenue_labels': [start.strftime('%m/%Y') for start in month_starts],
+        'revenue': [
+            months[m.strftime('%Y-%m')].amount / 100.0 if m.strftime('%Y-%m') in months else 0
+            for m in month_starts
+        ],
+        'monthly_subs': sum(row.monthly_count for row in months.values()),
+        'yearly_subs': sum(row.yearly_count for row in months.values()),
+        'month_revenue': (current.amount if current else 0) / 100.0,
+        'total_users': sum(plan_counts.values()),
+        'total_qrcodes': total_qrcodes.value if total_qrcodes else 0,
+        'total_revenue': sum(row.amount for row in months.values()) / 100.0,
         'active_subs': active_subs,
         'plan_counts': plan_counts,
     }
 
 
+@app.route('/admin/stats/data')
+@login_required
+def admin_stats_data():
+    if not is_admin():
+        return 'Unauthorized', 403
+    stats_range = request.args.get('range', '24h')
+    if stats_range not in STATS_RANGES:
+        return 'Unsupported range', 400
+    with _stats_cache_lock:
+        cached = _stats_cache.get(stats_range)
+        if cached is None or cached['expires'] <= time.monotonic():
+            cached = _stats_cache[stats_range] = {
+                'data': compute_admin_stats(stats_range),
+                'expires': time.monotonic() + app.config['STATS_CACHE_SECONDS'],
+            }
+        data = dict(cached['data'])
+    data['render_cache'] = render_cache.stats()
+    return data
+
+
+def scan_totals(public_ids, days=30):
+    """Scans of the last days per public id, read from the hourly counters."""
+    if not public_ids:
+        return {}
+    since = datetime.utcnow() - timedelta(days=days)
+    return dict(db.session.query(ScanHourly.public_id, func.sum(ScanHourly.count)).filter(
+        ScanHourly.public_id.in_(public_ids), ScanHourly.bucket >= since
+    ).group_by(ScanHourly.public_id).all())
+
+
+@app.route('/api/qrcodes/<string:qr_id>/scans')
+@login_required
+def api_qrcode_scans(qr_id):
+    """Scans of one QR code per hour, day or month (?range=24h|30d|12m)."""
+    stats_range = request.args.get('range', '30d')
+    if stats_range not in STATS_RANGES:
+        return 'Unsupported range', 400
+    qr = QRCode.query.filter_by(public_id=qr_id).first_or_404()
+    if qr.user_id != current_user.id and not is_admin():
+        return 'Unauthorized', 403
+    count, unit = STATS_RANGES[stats_range]
+    starts = _bucket_starts(datetime.utcnow(), count, unit)
+    scans = Counter()
+    for row in ScanHourly.query.filter(
+        ScanHourly.public_id == qr_id, ScanHourly.bucket >= starts[0]
+    ):
+        scans[_bucket_key(row.bucket, unit)] += row.count
+    counts = [scans[start] for start in starts]
+    return {
+        'range': stats_range,
+        'unit': unit,
+        'labels': [_bucket_label(start, unit) for start in starts],
+        'counts': counts,
+        'total': sum(counts),
+    }
+
+
 @app.route('/admin/permissions')
 @login_required
 def admin_permissions():
@@ -895,19 +3876,21 @@ def admin_permissions():
     db_path = os.path.join(root_dir, 'database.db')
     add_entry('database.db', db_path)
 
-    # User directories under qrcodes/
+    # First-level shard directories under qrcodes/
     if os.path.isdir(upload_root):
-        for name in os.listdir(upload_root):
-            user_dir = os.path.join(upload_root, name)
-            if os.path.isdir(user_dir):
-                rel = os.path.relpath(user_dir, root_dir)
-                add_entry(rel, user_dir)
+        with os.scandir(upload_root) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir():
+                    rel = os.path.relpath(entry.path, root_dir)
+                    add_entry(rel, entry.path)
 
-    # Walk entire project directory
+    # Walk the project directory without descending into the shards
     for dirpath, dirnames, _ in os.walk(root_dir):
         rel = os.path.relpath(dirpath, root_dir)
         label = rel if rel != '.' else '.'
         add_entry(label, dirpath)
+        if os.path.abspath(dirpath) == os.path.abspath(upload_root):
+            dirnames[:] = []
 
     return render_template('admin_permissions.html', dir_info=dir_info)
 
@@ -955,8 +3938,15 @@ def admin_user_qrcodes(user_id):
     if not is_admin():
         return 'Unauthorized', 403
     user = User.query.get_or_404(user_id)
-    qrcodes = QRCode.query.filter_by(user_id=user_id).all()
-    return render_template('user_qrcodes.html', user=user, qrcodes=qrcodes)
+    qrcodes, prev_cursor, next_cursor = qrcode_page(user_id)
+    return render_template(
+        'user_qrcodes.html',
+        user=user,
+        qrcodes=qrcodes,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        total=count_user_qrcodes(user_id),
+    )
 
 
 @app.route('/admin/qrcode/<string:qr_id>/delete', methods=['POST'])
@@ -966,14 +3956,8 @@ def admin_delete_qrcode(qr_id):
         return 'Unauthorized', 403
     qr = QRCode.query.filter_by(public_id=qr_id).first_or_404()
     user_id = qr.user_id
-    for path in [qr.png_path, qr.jpg_path, qr.svg_path]:
-        if path and os.path.exists(path):
-            try:
-                os.remove(path)
-            except OSError:
-                flash('Datei konnte nicht entfernt werden', 'danger')
     try:
-        db.session.delete(qr)
+        mark_qrcodes_deleted(QRCode.id == qr.id)
         db.session.commit()
     except Exception:
         db.session.rollback()
@@ -989,16 +3973,8 @@ def delete_user(user_id):
     if not is_admin():
         return 'Unauthorized', 403
     user = User.query.get_or_404(user_id)
-    # remove QR code files
-    for qr in user.qrcodes:
-        for path in [qr.png_path, qr.jpg_path, qr.svg_path]:
-            if path and os.path.exists(path):
-                try:
-                    os.remove(path)
-                except OSError:
-                    flash('Datei konnte nicht entfernt werden', 'danger')
-        db.session.delete(qr)
     try:
+        mark_qrcodes_deleted(QRCode.user_id == user.id)
         db.session.delete(user)
         db.session.commit()
     except Exception:
@@ -1027,69 +4003,339 @@ def handle_exception(e):
     traceback.print_exc()
     return render_template('error.html'), 500
 
+# Application setup
+#
+# Importing this module only defines the application. create_app() prepares
+# a serving process, the background threads start in every worker on its
+# first request and 'flask migrate' upgrades the database once per deploy.
+
+_init_lock = threading.Lock()
+_initialized = False
+_background_pid = None
+
+
+def create_app():
+    """Initialize the application once per process and return it."""
+    global _initialized
+    with _init_lock:
+        if not _initialized:
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            check_permissions()
+            # Workers of one server share this id, see claim_server_task()
+            os.environ.setdefault('QRCODE_SERVER_ID', str(secrets.randbelow(2 ** 31)))
+            app.config['BACKGROUND_TASKS'] = True
+            with app.app_context():
+                check_schema_version()
+            _initialized = True
+    return app
+
+
+def claim_server_task(name):
+    """Return True in the first process of this server that claims name."""
+    server_id = int(os.environ['QRCODE_SERVER_ID'])
+    if db.session.get(JobCheckpoint, name) is None:
+        db.session.add(JobCheckpoint(name=name))
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+    claimed = db.session.execute(
+        update(JobCheckpoint)
+        .where(
+            JobCheckpoint.name == name,
+            (JobCheckpoint.position.is_(None)) | (JobCheckpoint.position != server_id),
+        )
+        .values(position=server_id)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+# The reconciler and the sweepers work in one process at a time. That process
+# holds a lease in job_checkpoint (its token as position, updated_at as the
+# heartbeat) and renews it every third of SWEEPER_LEASE_SECONDS. When it dies
+# without releasing the lease, any other process takes over once it expired.
+SWEEPER_LEASE_SECONDS = 60
+_sweeper_lease = threading.Event()
+_lease_thread = None
+
+
+def renew_lease(name, token, now=None):
+    """Take or refresh the lease on name; return True while token holds it."""
+    now = now or datetime.utcnow()
+    if db.session.get(JobCheckpoint, name) is None:
+        db.session.add(JobCheckpoint(name=name))
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+    held = db.session.execute(
+        update(JobCheckpoint)
+        .where(
+            JobCheckpoint.name == name,
+            (JobCheckpoint.position == token)
+            | JobCheckpoint.position.is_(None)
+            | (JobCheckpoint.updated_at < now - timedelta(seconds=SWEEPER_LEASE_SECONDS)),
+        )
+        .values(position=token, updated_at=now)
+    ).rowcount
+    db.session.commit()
+    return held == 1
+
+
+def release_lease(name, token):
+    """Give up the lease on name so that another process takes it at once."""
+    try:
+        with app.app_context():
+            db.session.execute(
+                update(JobCheckpoint)
+                .where(JobCheckpoint.name == name, JobCheckpoint.position == token)
+                .values(position=None)
+            )
+            db.session.commit()
+    except Exception as e:
+        print(f'Releasing {name} failed:', e)
+
+
+def start_lease_keeper():
+    """Keep _sweeper_lease set while this process holds the sweeper lease."""
+    global _lease_thread
+    if _lease_thread is not None:
+        return
+    token = secrets.randbelow(2 ** 31)
+
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    held = renew_lease('sweepers', token)
+            except Exception as e:
+                print('Lease renewal failed:', e)
+                held = False
+            if held:
+                _sweeper_lease.set()
+            else:
+                _sweeper_lease.clear()
+            time.sleep(SWEEPER_LEASE_SECONDS / 3)
+
+    _lease_thread = threading.Thread(target=run, name='qr-lease', daemon=True)
+    _lease_thread.start()
+    atexit.register(release_lease, 'sweepers', token)
+
+
+@app.before_request
+def start_background_tasks():
+    """Start the background threads of this process on its first request.
+
+    Threads do not survive a fork, so a preloading server never starts them
+    itself; each worker does once it serves requests. The scan flusher runs
+    in every worker since it drains that worker's buffer. The reconciler and
+    the sweepers are started everywhere too but only work in the process
+    holding the sweeper lease.
+    """
+    global _background_pid
+    if not app.config.get('BACKGROUND_TASKS') or _background_pid == os.getpid():
+        return
+    with _init_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+        # Pooled connections inherited from the parent must not be shared
+        db.engine.dispose(close=False)
+        start_scan_flusher()
+        start_lease_keeper()
+        start_reconciler()
+        start_deletion_sweeper()
+        start_plan_expiry_sweeper()
+        if claim_server_task('render-resume'):
+            resume_render_jobs()
+
+
+# Schema migrations
+#
+# Each migration upgrades the database by one version and is safe to run
+# again, so an interrupted upgrade simply resumes. The version is stored in
+# schema_version; processes only compare it with SCHEMA_VERSION on startup.
+
+MIGRATION_BATCH_SIZE = 5000
+
+# Columns added to databases created by older releases (SQLite only)
+LEGACY_COLUMNS = {
+    'user': (
+        ('upgrade_method', 'VARCHAR(20)'),
+        ('paypal_subscription_id', 'VARCHAR(255)'),
+        ('stripe_subscription_id', 'VARCHAR(255)'),
+        ('plan_expires_at', 'DATETIME'),
+        ('plan_cancelled', 'BOOLEAN DEFAULT 0'),
+        ('created_at', 'DATETIME'),
+    ),
+    'qr_code': (
+        ('created_at', 'DATETIME'),
+        ('data_type', "VARCHAR(20) DEFAULT 'url'"),
+        ('public_id', 'VARCHAR(16)'),
+        ('payload', 'VARCHAR(2048)'),
+        ('color', "VARCHAR(32) DEFAULT 'black'"),
+        ('bgcolor', "VARCHAR(32) DEFAULT 'white'"),
+        ('style', "VARCHAR(20) DEFAULT 'square'"),
+        ('gradient', 'BOOLEAN DEFAULT 0'),
+        ('gradient_color', 'VARCHAR(32)'),
+        ('render_status', "VARCHAR(20) DEFAULT 'done'"),
+    ),
+}
+
+
+def backfill(conn, table, assignment, condition, batch_size=MIGRATION_BATCH_SIZE):
+    """Run UPDATE table SET assignment WHERE condition in committed batches."""
+    total = 0
+    while True:
+        updated = conn.execute(text(
+            f'UPDATE "{table}" SET {assignment} WHERE id IN '
+            f'(SELECT id FROM "{table}" WHERE {condition} LIMIT {batch_size})'
+        )).rowcount
+        conn.commit()
+        total += updated
+        if updated < batch_size:
+            return total
+
+
+def create_indexes(conn, *indexes):
+    for name, table, columns in indexes:
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({columns})'))
+
+
+def _migrate_legacy_columns(conn):
+    if conn.dialect.name != 'sqlite':
+        # Databases of other dialects are always created by create_all()
+        return
+    for table, columns in LEGACY_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(text(f'PRAGMA table_info("{table}")'))}
+        for column, definition in columns:
+            if column not in existing:
+                conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}'))
+    conn.commit()
+    for table in LEGACY_COLUMNS:
+        backfill(conn, table, 'created_at = CURRENT_TIMESTAMP', 'created_at IS NULL')
+
+
+def _migrate_statistics_indexes(conn):
+    create_indexes(
+        conn,
+        ('ix_user_created_at', 'user', 'created_at'),
+        ('ix_user_plan', 'user', 'plan'),
+        ('ix_qr_code_created_at', 'qr_code', 'created_at'),
+        ('ix_payment_created_at', 'payment', 'created_at'),
+        ('ix_payment_period', 'payment', 'period'),
+    )
+
+
+def _migrate_listing_indexes(conn):
+    # (user_id, id) also serves every lookup by user_id alone
+    create_indexes(
+        conn,
+        ('ix_qr_code_user_id_id', 'qr_code', 'user_id, id'),
+        ('ix_payment_user_id_created_at', 'payment', 'user_id, created_at'),
+    )
+
+
+def _migrate_statistics_rollups(conn):
+    # Tables created after the rollups started counting are filled already
+    if PlanCount.query.first() is None and User.query.first() is not None:
+        rebuild_stats()
+
+
+def _migrate_scan_tables(conn):
+    # migrate_database() creates them with create_all() already; the version
+    # makes running processes warn until the database has been migrated
+    db.metadata.create_all(conn, tables=[ScanEvent.__table__, ScanHourly.__table__])
+
+
+def _migrate_pending_deletion_files(conn):
+    # Only files are queued: per-user folders went away with the sharded
+    # layout and their leftovers are removed by migrate-files
+    columns = {column['name'] for column in db.inspect(conn).get_columns('pending_deletion')}
+    if 'is_dir' in columns:
+        conn.execute(text('ALTER TABLE pending_deletion DROP COLUMN is_dir'))
+
+
+MIGRATIONS = (
+    (1, 'Add columns introduced since the first release', _migrate_legacy_columns),
+    (2, 'Index the columns of the admin statistics', _migrate_statistics_indexes),
+    (3, 'Index QR codes and payments per user', _migrate_listing_indexes),
+    (4, 'Fill the statistics rollup tables', _migrate_statistics_rollups),
+    (5, 'Create the scan analytics tables', _migrate_scan_tables),
+    (6, 'Drop the folder flag of queued deletions', _migrate_pending_deletion_files),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version():
+    """Version of the database schema, 0 for databases never migrated."""
+    try:
+        row = db.session.get(SchemaVersion, 1)
+    except Exception:
+        db.session.rollback()
+        return 0
+    return row.version if row else 0
+
+
+def set_schema_version(version):
+    row = db.session.get(SchemaVersion, 1)
+    if row is None:
+        row = SchemaVersion(id=1)
+        db.session.add(row)
+    row.version = version
+    db.session.commit()
+
+
+def migrate_database(echo=print):
+    """Create missing tables and apply the pending migrations in order."""
+    fresh = not db.inspect(db.engine).has_table('user')
+    db.create_all()
+    if fresh:
+        # create_all() already built the latest schema
+        set_schema_version(SCHEMA_VERSION)
+        return
+    current = schema_version()
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        echo(f'Migration {version}: {description}')
+        with db.engine.connect() as conn:
+            migration(conn)
+            conn.commit()
+        set_schema_version(version)
+
+
+def check_schema_version():
+    """Warn when the database is older than this release expects."""
+    version = schema_version()
+    if version < SCHEMA_VERSION:
+        print(
+            f'Database schema version {version} is older than {SCHEMA_VERSION}; '
+            "run 'flask --app app migrate'"
+        )
+    return version
+
+
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='Only show the schema version.')
+def migrate_command(status):
+    """Upgrade the database and reconcile the QR code files once."""
+    if status:
+        click.echo(f'Schema version {schema_version()} of {SCHEMA_VERSION}')
+        return
+    migrate_database(echo=click.echo)
+    create_app()
+    report = cleanup_orphaned_qrcodes()
+    click.echo(
+        f"Database at schema version {SCHEMA_VERSION}; {len(report['cleared'])} missing files, "
+        f"{len(report['orphans'])} orphaned files removed"
+    )
+
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
-        # Ensure older databases contain the new column introduced for
-        # tracking how a user upgraded. SQLite will ignore the command if the
-        # column already exists.
-        with db.engine.begin() as conn:
-            result = conn.execute(text('PRAGMA table_info(user)'))
-            columns = [row[1] for row in result]
-            if 'upgrade_method' not in columns:
-                conn.execute(
-                    text(
-                        'ALTER TABLE user ADD COLUMN upgrade_method '
-                        'VARCHAR(20)'
-                    )
-                )
-            if 'paypal_subscription_id' not in columns:
-                conn.execute(
-                    text(
-                        'ALTER TABLE user ADD COLUMN paypal_subscription_id '
-                        'VARCHAR(255)'
-                    )
-                )
-            if 'stripe_subscription_id' not in columns:
-                conn.execute(
-                    text(
-                        'ALTER TABLE user ADD COLUMN stripe_subscription_id '
-                        'VARCHAR(255)'
-                    )
-                )
-            if 'plan_expires_at' not in columns:
-                conn.execute(
-                    text(
-                        'ALTER TABLE user ADD COLUMN plan_expires_at DATETIME'
-                    )
-                )
-            if 'plan_cancelled' not in columns:
-                conn.execute(
-                    text(
-                        'ALTER TABLE user ADD COLUMN plan_cancelled BOOLEAN '
-                        'DEFAULT 0'
-                    )
-                )
-            if 'created_at' not in columns:
-                conn.execute(
-                    text(
-                        'ALTER TABLE user ADD COLUMN created_at DATETIME'
-                    )
-                )
-                conn.execute(text("UPDATE user SET created_at = CURRENT_TIMESTAMP"))
-            result = conn.execute(text('PRAGMA table_info(qr_code)'))
-            qr_columns = [row[1] for row in result]
-            if 'created_at' not in qr_columns:
-                conn.execute(text('ALTER TABLE qr_code ADD COLUMN created_at DATETIME'))
-                conn.execute(text("UPDATE qr_code SET created_at = CURRENT_TIMESTAMP"))
-            if 'data_type' not in qr_columns:
-                conn.execute(text("ALTER TABLE qr_code ADD COLUMN data_type VARCHAR(20) DEFAULT 'url'"))
-            if 'public_id' not in qr_columns:
-                conn.execute(text("ALTER TABLE qr_code ADD COLUMN public_id VARCHAR(16)"))
-            result = conn.execute(text('PRAGMA table_info(payment)'))
-            payment_columns = [row[1] for row in result]
-            if not payment_columns:
-                Payment.__table__.create(conn)
-        cleanup_orphaned_qrcodes()
+        migrate_database()
+    create_app()
     debug_mode = os.environ.get('FLASK_DEBUG') == '1'
     app.run(host='0.0.0.0', port=8010, debug=debug_mode)
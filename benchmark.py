@@ -0,0 +1,608 @@
+"""Benchmarks for the QR code pipeline and the hot HTTP routes.
+
+Usage::
+
+    python benchmark.py [SUITE ...] [--repeat N] [--max-users N] [--json FILE]
+
+Suites:
+
+``render-paths``
+    StyledPilImage renderer against the fast matrix renderer.
+``matrix``
+    Version, module count and build time with the adaptive error correction
+    per style against a fixed H level.
+``render``
+    ``generate_qr_files()`` for every payload, drawer style and gradient
+    setting, uncached and served from the render cache.
+``svg``
+    Size, gzipped size and encode time of the path SVG writer for every
+    style against qrcode's ``SvgImage``.
+``encode``
+    Size and encode time of every raster format with the tuned encoder
+    settings against the previous ones.
+``db``
+    ``enforce_qrcode_limit()`` and ``cleanup_orphaned_qrcodes()`` with
+    growing numbers of users and QR code rows.
+``routes``
+    ``index``, ``preview`` and ``show_qr`` through the Flask test client,
+    with and without the file and scan indexes.
+``concurrency``
+    N worker processes creating, listing and previewing codes against one
+    SQLite file, with the WAL/pragma tuning switched off and on.
+
+Every run uses a scratch SQLite database and upload folder. Results are
+written as JSON with ``--json`` so runs of different commits can be
+compared.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+PAYLOADS = {
+    'url': 'https://qr.example.com/qr/abcd1234',
+    'long_url': 'https://qr.example.com/landing?' + '&'.join(
+        f'utm_param{i}=value{i}' for i in range(12)
+    ),
+    'long_text': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 9,
+    'vcard': (
+        'BEGIN:VCARD\nVERSION:3.0\nFN:Erika Mustermann\n'
+        'TEL:+49 170 1234567\nEMAIL:erika.mustermann@example.com\nEND:VCARD'
+    ),
+}
+
+STYLES = ('square', 'rounded', 'circle', 'vertical', 'horizontal')
+
+USER_COUNTS = (1, 100, 1000, 10000, 100000)
+
+SUITES = ('render-paths', 'matrix', 'render', 'svg', 'encode', 'db', 'routes', 'concurrency')
+
+
+def measure(func, repeat):
+    """Call func repeat times and return latency percentiles and throughput."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))], 3)
+
+    mean = statistics.mean(samples)
+    return {
+        'n': repeat,
+        'mean_ms': round(mean, 3),
+        'p50_ms': percentile(0.50),
+        'p90_ms': percentile(0.90),
+        'p99_ms': percentile(0.99),
+        'min_ms': round(samples[0], 3),
+        'ops_per_sec': round(1000 / mean, 1) if mean else 0.0,
+    }
+
+
+def setup_app(workdir):
+    """Import the application against a scratch database and upload folder."""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'qrcodes')
+    # Render in the request so the routes measure the full work
+    os.environ['RENDER_WORKERS'] = '0'
+    import app as qrapp
+
+    qrapp.app.config['TESTING'] = True
+    with qrapp.app.app_context():
+        qrapp.db.create_all()
+    return qrapp
+
+
+def reset_database(qrapp):
+    with qrapp.app.app_context():
+        qrapp.db.drop_all()
+        qrapp.db.create_all()
+    qrapp.file_index.clear()
+
+
+def bench_render_paths(qrapp, args):
+    """Time styled and fast rasterization for each payload size."""
+    front, back = (0, 0, 0), (255, 255, 255)
+    results = {}
+    for name, payload in PAYLOADS.items():
+        qr = qrapp.build_qr(payload)
+        styled = qrapp.render_qr_styled(qr, front, back).convert('RGB')
+        fast = qrapp.render_qr_matrix(qr, front, back).convert('RGB')
+        if styled.tobytes() != fast.tobytes():
+            raise AssertionError(f'Renderers disagree for payload {name}')
+        results[name] = {
+            'modules': qr.modules_count,
+            'styled': measure(lambda: qrapp.render_qr_styled(qr, front, back), args.repeat),
+            'fast': measure(lambda: qrapp.render_qr_matrix(qr, front, back), args.repeat),
+        }
+        styled_p50 = results[name]['styled']['p50_ms']
+        fast_p50 = results[name]['fast']['p50_ms']
+        print(
+            f'render-paths {name:<10} modules={qr.modules_count:<4} '
+            f'styled={styled_p50:.2f}ms fast={fast_p50:.2f}ms '
+            f'speedup={styled_p50 / fast_p50 if fast_p50 else 0:.1f}x'
+        )
+    return results
+
+
+def bench_matrix(qrapp, args):
+    """Compare the adaptive error correction with a fixed H level per style."""
+    import qrcode
+
+    def fixed_h(payload):
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, border=4)
+        qr.add_data(payload)
+        qr.make(fit=True)
+        return qr
+
+    levels = {
+        qrcode.constants.ERROR_CORRECT_L: 'L',
+        qrcode.constants.ERROR_CORRECT_M: 'M',
+        qrcode.constants.ERROR_CORRECT_Q: 'Q',
+        qrcode.constants.ERROR_CORRECT_H: 'H',
+    }
+    front, back, grad = (0x11, 0x22, 0x33), (255, 255, 255), (255, 0, 0)
+    results = {}
+    for name, payload in PAYLOADS.items():
+        old = fixed_h(payload)
+        results[name] = {
+            'fixed_h': {
+                'modules': old.modules_count,
+                'build': measure(lambda: fixed_h(payload), args.repeat),
+            },
+        }
+        for style in STYLES:
+            for gradient in (False, True):
+
+                def build():
+                    return qrapp.build_qr(payload, style=style, gradient=gradient)
+
+                qr = build()
+                img = qrapp.render_qr_image(qr, front, back, grad if gradient else None, style)
+                results[name][f'{style}/{"gradient" if gradient else "solid"}'] = {
+                    'modules': qr.modules_count,
+                    'level': levels[qr.error_correction],
+                    'build': measure(build, args.repeat),
+                    'png_bytes': len(qrapp.encode_qr_image(qr, img, 'png')),
+                }
+        for key, row in results[name].items():
+            print(
+                f'matrix {name:<10} {key:<20} level={row.get("level", "H")} '
+                f'modules={row["modules"]:<4} p50={row["build"]["p50_ms"]:.2f}ms'
+                + (f' png={row["png_bytes"]}' if 'png_bytes' in row else '')
+            )
+    return results
+
+
+def bench_render(qrapp, args):
+    """Time generate_qr_files() for all payloads, styles and gradients."""
+    results = {}
+    counter = iter(range(10 ** 9))
+    for name, payload in PAYLOADS.items():
+        for style in STYLES:
+            for gradient in (False, True):
+                params = {
+                    'color': '#112233',
+                    'bgcolor': '#ffffff',
+                    'style': style,
+                    'gradient': gradient,
+                    'gradient_color': '#ff0000',
+                }
+
+                def uncached():
+                    # A unique suffix defeats the render cache
+                    qrapp.generate_qr_files(
+                        f'{payload}#{next(counter)}', file_id='bench', **params
+                    )
+
+                def cached():
+                    qrapp.generate_qr_files(payload, file_id='bench', **params)
+
+                cached()
+                key = f'{name}/{style}/{"gradient" if gradient else "solid"}'
+                results[key] = {
+                    'uncached': measure(uncached, args.repeat),
+                    'cached': measure(cached, args.repeat),
+                }
+                print(
+                    f'render {key:<32} uncached p50={results[key]["uncached"]["p50_ms"]:.2f}ms '
+                    f'cached p50={results[key]["cached"]["p50_ms"]:.2f}ms'
+                )
+    results['render_cache'] = qrapp.render_cache.stats()
+    return results
+
+
+def bench_svg(qrapp, args):
+    """Compare the path SVG writer with qrcode's SvgImage (one rect per module)."""
+    import gzip
+
+    import qrcode.image.svg
+
+    def svg_image(qr):
+        buf = io.BytesIO()
+        qr.make_image(image_factory=qrcode.image.svg.SvgImage).save(buf)
+        return buf.getvalue()
+
+    front, back, grad = (0x11, 0x22, 0x33), (255, 255, 255), (255, 0, 0)
+    results = {}
+    for name, payload in PAYLOADS.items():
+        qr = qrapp.build_qr(payload)
+        old = svg_image(qr)
+        results[name] = {
+            'svgimage': {
+                'bytes': len(old),
+                'gzip_bytes': len(gzip.compress(old)),
+                'encode': measure(lambda: svg_image(qr), args.repeat),
+            },
+        }
+        for style in STYLES:
+            for gradient in (None, grad):
+                styled_qr = qrapp.build_qr(payload, style=style, gradient=bool(gradient))
+
+                def encode():
+                    return qrapp.render_qr_svg(styled_qr, front, back, gradient, style)
+
+                data = encode()
+                results[name][f'{style}/{"gradient" if gradient else "solid"}'] = {
+                    'bytes': len(data),
+                    'gzip_bytes': len(gzip.compress(data)),
+                    'encode': measure(encode, args.repeat),
+                }
+        for key, row in results[name].items():
+            print(
+                f'svg {name:<10} {key:<20} bytes={row["bytes"]:<7} '
+                f'gzip={row["gzip_bytes"]:<6} p50={row["encode"]["p50_ms"]:.2f}ms'
+            )
+    return results
+
+
+def bench_encode(qrapp, args):
+    """Compare encode_qr_image() with the previous encoder settings per format."""
+
+    def previous(img, fmt):
+        # Pillow's defaults, except for the lossless WebP that was always used
+        buf = io.BytesIO()
+        if fmt == 'png':
+            img.save(buf, format='PNG')
+        elif fmt == 'jpg':
+            img.convert('RGB').save(buf, format='JPEG')
+        else:
+            img.convert('RGB').save(buf, format=fmt.upper(), lossless=fmt == 'webp')
+        return buf.getvalue()
+
+    front, back, grad = (0x11, 0x22, 0x33), (255, 255, 255), (255, 0, 0)
+    formats = [fmt for fmt in qrapp.RASTER_FORMATS if fmt in qrapp.DOWNLOAD_FORMATS]
+    results = {}
+    for name, payload in PAYLOADS.items():
+        for style in ('square', 'rounded', 'circle'):
+            for gradient in (None, grad):
+                qr = qrapp.build_qr(payload, style=style, gradient=bool(gradient))
+                img = qrapp.render_qr_image(qr, front, back, gradient, style)
+                key = f'{name}/{style}/{"gradient" if gradient else "solid"}'
+                results[key] = {}
+                for fmt in formats:
+                    row = {}
+                    for variant, encode in (
+                        ('previous', lambda: previous(img, fmt)),
+                        ('tuned', lambda: qrapp.encode_qr_image(qr, img, fmt)),
+                    ):
+                        row[variant] = {
+                            'bytes': len(encode()),
+                            'encode': measure(encode, args.repeat),
+                        }
+                    results[key][fmt] = row
+                    print(
+                        f'encode {key:<28} {fmt:<4} '
+                        f'bytes={row["previous"]["bytes"]}->{row["tuned"]["bytes"]} '
+                        f'p50={row["previous"]["encode"]["p50_ms"]:.2f}'
+                        f'->{row["tuned"]["encode"]["p50_ms"]:.2f}ms'
+                    )
+    return results
+
+
+def populate(qrapp, users, codes_per_user=1, plan='premium'):
+    """Insert users and QR code rows with bulk statements."""
+    reset_database(qrapp)
+    now = datetime.utcnow()
+    with qrapp.app.app_context():
+        qrapp.db.session.execute(
+            qrapp.User.__table__.insert(),
+            [
+                {
+                    'username': f'user{i}',
+                    'email': f'user{i}@example.com',
+                    'plan': plan,
+                    'created_at': now,
+                }
+                for i in range(users)
+            ],
+        )
+        user_ids = qrapp.db.session.execute(qrapp.db.select(qrapp.User.id)).scalars().all()
+        qrapp.db.session.execute(
+            qrapp.QRCode.__table__.insert(),
+            [
+                {
+                    'public_id': f'{user_id:06x}{n:02x}',
+                    'url': 'https://example.com',
+                    'data_type': 'url',
+                    'payload': f'https://qr.example.com/qr/{user_id:06x}{n:02x}',
+                    'color': 'black',
+                    'bgcolor': 'white',
+                    'style': 'square',
+                    'gradient': False,
+                    'render_status': 'done',
+                    'created_at': now,
+                    'user_id': user_id,
+                }
+                for user_id in user_ids
+                for n in range(codes_per_user)
+            ],
+        )
+        qrapp.db.session.commit()
+        return user_ids
+
+
+def bench_db(qrapp, args):
+    """Time limit enforcement and orphan cleanup against growing tables."""
+    results = {}
+    for users in (n for n in USER_COUNTS if n <= args.max_users):
+        # Basic users with one code more than their limit, so every call
+        # deletes a code; each user can be trimmed only once
+        limit = qrapp.PLAN_LIMITS['basic']
+        user_ids = populate(qrapp, users, codes_per_user=limit + 1, plan='basic')
+        repeat = min(args.repeat, users)
+        with qrapp.app.app_context():
+            over_limit = iter(
+                qrapp.User.query.filter(qrapp.User.id.in_(user_ids[:repeat])).all()
+            )
+            row = {
+                'enforce_qrcode_limit': measure(
+                    lambda: qrapp.enforce_qrcode_limit(next(over_limit)), repeat
+                ),
+                'cleanup_orphaned_qrcodes': measure(
+                    qrapp.cleanup_orphaned_qrcodes, max(1, args.repeat // 10)
+                ),
+            }
+            deleted = users * (limit + 1) - qrapp.QRCode.query.count()
+        results[str(users)] = row
+        print(
+            f'db users={users:<7} enforce p50={row["enforce_qrcode_limit"]["p50_ms"]:.2f}ms '
+            f'({deleted} codes deleted) '
+            f'cleanup p50={row["cleanup_orphaned_qrcodes"]["p50_ms"]:.2f}ms'
+        )
+    return results
+
+
+def bench_routes(qrapp, args):
+    """Time the hot routes for a logged in user with a full premium plan."""
+    from werkzeug.security import generate_password_hash
+
+    results = {}
+    for users in (n for n in USER_COUNTS if n <= args.max_users):
+        populate(qrapp, users)
+        with qrapp.app.app_context():
+            user = qrapp.db.session.get(qrapp.User, 1)
+            user.password_hash = generate_password_hash('bench')
+            qrapp.db.session.commit()
+            public_id = qrapp.QRCode.query.filter_by(user_id=1).first().public_id
+        client = qrapp.app.test_client()
+        client.post('/login', data={'username': 'user0', 'password': 'bench'})
+
+        def preview_db():
+            # Without the file index every request queries the database
+            qrapp.file_index.clear()
+            client.get(f'/preview/{public_id}')
+
+        def show_qr_db():
+            # Without the scan index every scan queries the database
+            qrapp.scan_index.clear()
+            scanner.get(f'/qr/{public_id}')
+
+        # Scans come from visitors that are not logged in
+        scanner = qrapp.app.test_client()
+        row = {
+            'index': measure(lambda: client.get('/'), args.repeat),
+            'preview_db': measure(preview_db, args.repeat),
+            'preview_indexed': measure(lambda: client.get(f'/preview/{public_id}'), args.repeat),
+            'show_qr_db': measure(show_qr_db, args.repeat),
+            'show_qr': measure(lambda: scanner.get(f'/qr/{public_id}'), args.repeat),
+        }
+        results[str(users)] = row
+        print(
+            f'routes users={users:<7} '
+            + ' '.join(f'{name}={r["p50_ms"]:.2f}ms' for name, r in row.items())
+        )
+    return results
+
+
+def _concurrency_env(workdir, tuning):
+    name = 'tuned' if tuning else 'default'
+    return {
+        'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, f'concurrency-{name}.db'),
+        'UPLOAD_FOLDER': os.path.join(workdir, f'concurrency-{name}'),
+        'RENDER_WORKERS': '0',
+        'SQLITE_TUNING': '1' if tuning else '0',
+    }
+
+
+def _concurrency_setup(env, workers):
+    """Create the schema and one unlimited user per worker process."""
+    os.environ.update(env)
+    from werkzeug.security import generate_password_hash
+    import app as qrapp
+
+    with qrapp.app.app_context():
+        qrapp.db.create_all()
+        password_hash = generate_password_hash('bench')
+        for i in range(workers):
+            qrapp.db.session.add(qrapp.User(
+                username=f'worker{i}',
+                email=f'worker{i}@example.com',
+                plan='unlimited',
+                password_hash=password_hash,
+            ))
+        qrapp.db.session.commit()
+
+
+def _concurrency_worker(env, index, duration):
+    """Create, list and preview codes for duration seconds in one process."""
+    os.environ.update(env)
+    import app as qrapp
+
+    qrapp.app.config['TESTING'] = True
+    client = qrapp.app.test_client()
+    client.post('/login', data={'username': f'worker{index}', 'password': 'bench'})
+    samples = {'create': [], 'list': [], 'preview': []}
+    errors = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for op in samples:
+            start = time.perf_counter()
+            if op == 'create':
+                response = client.post('/', data={
+                    'data_type': 'text',
+                    'text': f'worker {index} at {start}',
+                    'color': '#000000',
+                    'bgcolor': '#ffffff',
+                    'style': 'square',
+                })
+                ok = response.status_code == 302
+            elif op == 'list':
+                response = client.get('/api/qrcodes?before=2147483647&limit=1')
+                ok = response.status_code == 200 and response.json['items']
+                if ok:
+                    newest = response.json['items'][0]['id']
+            else:
+                response = client.get(f'/preview/{newest}')
+                ok = response.status_code == 200
+            if not ok:
+                errors += 1
+                break
+            samples[op].append((time.perf_counter() - start) * 1000)
+    return samples, errors
+
+
+def bench_concurrency(qrapp, args):
+    """Throughput of create/list/preview rounds with N processes on SQLite."""
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for tuning in (False, True):
+        mode = 'tuned' if tuning else 'default'
+        for workers in args.workers:
+            env = _concurrency_env(args.workdir, tuning)
+            for suffix in ('', '-wal', '-shm'):
+                path = env['DATABASE_URL'][len('sqlite:///'):] + suffix
+                if os.path.exists(path):
+                    os.remove(path)
+            shutil.rmtree(env['UPLOAD_FOLDER'], ignore_errors=True)
+            with ctx.Pool(1) as pool:
+                pool.apply(_concurrency_setup, (env, workers))
+            with ctx.Pool(workers) as pool:
+                outcomes = pool.starmap(
+                    _concurrency_worker,
+                    [(env, i, args.duration) for i in range(workers)],
+                )
+            row = {'errors': sum(errors for _, errors in outcomes)}
+            for op in ('create', 'list', 'preview'):
+                samples = sorted(s for op_samples, _ in outcomes for s in op_samples[op])
+                row[op] = {
+                    'n': len(samples),
+                    'per_sec': round(len(samples) / args.duration, 1),
+                    'p50_ms': round(samples[len(samples) // 2], 3) if samples else None,
+                    'p99_ms': round(samples[int(len(samples) * 0.99)], 3) if samples else None,
+                }
+            results[f'{mode}/{workers}'] = row
+            print(
+                f'concurrency {mode:<7} workers={workers:<3} '
+                + ' '.join(
+                    f'{op}={row[op]["per_sec"]}/s p99={row[op]["p99_ms"]}ms'
+                    for op in ('create', 'list', 'preview')
+                )
+                + f' errors={row["errors"]}'
+            )
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('suites', nargs='*', metavar='SUITE')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-users', type=int, default=USER_COUNTS[-1])
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument(
+        '--workers', default='1,2,4,8',
+        help='Comma separated process counts of the concurrency suite',
+    )
+    parser.add_argument(
+        '--duration', type=float, default=5.0,
+        help='Seconds each concurrency run lasts',
+    )
+    args = parser.parse_args()
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error(f'unknown suites: {", ".join(sorted(unknown))}')
+    try:
+        args.workers = [int(n) for n in args.workers.split(',')]
+    except ValueError:
+        parser.error('--workers expects numbers such as 1,2,4')
+
+    workdir = tempfile.mkdtemp(prefix='qrcode-bench-')
+    try:
+        args.workdir = workdir
+        qrapp = setup_app(workdir)
+        suites = {
+            'render-paths': bench_render_paths,
+            'matrix': bench_matrix,
+            'render': bench_render,
+            'svg': bench_svg,
+            'encode': bench_encode,
+            'db': bench_db,
+            'routes': bench_routes,
+            'concurrency': bench_concurrency,
+        }
+        results = {
+            'meta': {
+                'revision': git_revision(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'timestamp': datetime.utcnow().isoformat() + 'Z',
+                'repeat': args.repeat,
+            },
+        }
+        for name in args.suites or SUITES:
+            results[name] = suites[name](qrapp, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Gunicorn settings, see the section "Betrieb" in the README.
+
+All values can be overridden with environment variables.
+"""
+import multiprocessing
+import os
+import secrets
+
+from dotenv import load_dotenv
+
+# Read .env once in the master; the workers inherit the variables
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'), override=True)
+os.environ['QRCODE_ENV_LOADED'] = '1'
+# Lets the workers of this server agree on one-time startup tasks
+os.environ['QRCODE_SERVER_ID'] = str(secrets.randbelow(2 ** 31))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8010')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# The workers split the CPU cores for their render pools, see RENDER_WORKERS
+os.environ['QRCODE_SERVER_WORKERS'] = str(workers)
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+# Import the application once in the master and fork the workers from it
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = 30
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+accesslog = '-'
@@ -0,0 +1,8 @@
+"""WSGI entry point for production servers.
+
+Start with ``gunicorn -c gunicorn.conf.py wsgi:app`` after running
+``flask --app app migrate`` once.
+"""
+from app import create_app
+
+app = create_app()